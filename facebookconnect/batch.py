@@ -0,0 +1,158 @@
+# Copyright 2008-2009 Brian Boyer, Ryan Mark, Angela Nitzke, Joshua Pollock,
+# Stuart Tiffen, Kayla Webley and the Medill School of Journalism, Northwestern
+# University.
+#
+# This file is part of django-facebookconnect.
+#
+# django-facebookconnect is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-facebookconnect is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with django-facebookconnect.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+log = logging.getLogger('facebookconnect.batch')
+import threading
+from urllib import urlencode
+
+from django.utils import simplejson
+
+from facebookconnect.transport import graph_api_error
+
+# facebook won't take more than this many calls in one batch
+MAX_BATCH_SIZE = 50
+
+
+class GraphBatch(object):
+    """
+    Queues up graph calls and sends them to facebook in one batch request
+    the first time any of their results is needed. Calls return a
+    LazyResult right away, which acts like the dict facebook sends back.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.queue = []
+        self._lock = threading.RLock()
+
+    def add(self, relative_url):
+        """queue a GET of relative_url and return its LazyResult"""
+        result = LazyResult(self, relative_url)
+        with self._lock:
+            self.queue.append(result)
+        return result
+
+    def get_object(self, id, **args):
+        return self.add(_url(id, args))
+
+    def get_objects(self, ids, **args):
+        args["ids"] = ",".join(ids)
+        return self.add(_url("", args))
+
+    def get_connections(self, id, connection_name, **args):
+        return self.add(_url("%s/%s" % (id, connection_name), args))
+
+    def flush(self):
+        """send everything that's queued"""
+        with self._lock:
+            queue, self.queue = self.queue, []
+            for start in range(0, len(queue), MAX_BATCH_SIZE):
+                self._send(queue[start:start + MAX_BATCH_SIZE])
+
+    def _send(self, results):
+        log.debug("Sending batch of %s" % [r.relative_url for r in results])
+        batch = [{"method": "GET", "relative_url": r.relative_url}
+                 for r in results]
+        try:
+            responses = self.graph.request(
+                "", post_args={"batch": simplejson.dumps(batch)})
+        except Exception, ex:
+            for result in results:
+                result._fail(ex)
+            return
+
+        for result, response in zip(results, responses):
+            if response is None:
+                result._fail(_batch_error(
+                    "No response for %s" % result.relative_url))
+                continue
+            try:
+                body = simplejson.loads(response["body"])
+            except (KeyError, ValueError), ex:
+                result._fail(_batch_error(str(ex)))
+                continue
+            if isinstance(body, dict) and body.get("error"):
+                result._fail(graph_api_error(body))
+            else:
+                result._resolve(body)
+
+
+class LazyResult(object):
+    """The result of a queued graph call, fetched when first used"""
+
+    def __init__(self, batch, relative_url):
+        self.batch = batch
+        self.relative_url = relative_url
+        self.done = False
+        self._value = None
+        self._error = None
+
+    def resolve(self):
+        """returns the result, sending the batch if needed"""
+        if not self.done:
+            self.batch.flush()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def _resolve(self, value):
+        self._value = value
+        self.done = True
+
+    def _fail(self, error):
+        self._error = error
+        self.done = True
+
+    def __getitem__(self, key):
+        return self.resolve()[key]
+
+    def __contains__(self, key):
+        return key in self.resolve()
+
+    def __iter__(self):
+        return iter(self.resolve())
+
+    def __len__(self):
+        return len(self.resolve())
+
+    def __nonzero__(self):
+        return bool(self.resolve())
+
+    def get(self, key, default=None):
+        return self.resolve().get(key, default)
+
+    def keys(self):
+        return self.resolve().keys()
+
+    def values(self):
+        return self.resolve().values()
+
+    def items(self):
+        return self.resolve().items()
+
+
+def _batch_error(message):
+    return graph_api_error({"error": {"type": "BatchError", "message": message}})
+
+
+def _url(path, args):
+    if args:
+        return "%s?%s" % (path, urlencode(args))
+    return path
@@ -0,0 +1,169 @@
+# Copyright 2008-2009 Brian Boyer, Ryan Mark, Angela Nitzke, Joshua Pollock,
+# Stuart Tiffen, Kayla Webley and the Medill School of Journalism, Northwestern
+# University.
+#
+# This file is part of django-facebookconnect.
+#
+# django-facebookconnect is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-facebookconnect is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with django-facebookconnect.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Keeps slow or failing graph calls from tying up the whole site.
+
+The circuit breaker watches every graph call in the process. When too many
+recent calls failed or were slow it opens, and graph calls fail right away
+with a CircuitOpenError instead of waiting on facebook. After a while one
+probe call is let through to see whether facebook is back.
+
+The latency budget limits how long a single request can spend waiting on
+graph calls. Both errors are URLErrors, so profiles treat them like any
+other network failure and fall back to cached or dummy info.
+"""
+
+import logging
+log = logging.getLogger('facebookconnect.breaker')
+import threading
+import time
+from collections import deque
+from urllib2 import URLError
+
+from django.conf import settings
+
+try:
+    from threading import local
+except ImportError:
+    from django.utils._threading_local import local
+
+_thread_locals = local()
+
+
+class CircuitOpenError(URLError):
+    pass
+
+
+class BudgetExceededError(URLError):
+    pass
+
+
+class CircuitBreaker(object):
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_rate=None, slow_call_time=None, window=None,
+                 min_calls=None, reset_timeout=None):
+        self.failure_rate = failure_rate or \
+            getattr(settings, 'FACEBOOK_BREAKER_FAILURE_RATE', 0.5)
+        self.slow_call_time = slow_call_time or \
+            getattr(settings, 'FACEBOOK_BREAKER_SLOW_CALL_TIME', 3)
+        self.min_calls = min_calls or \
+            getattr(settings, 'FACEBOOK_BREAKER_MIN_CALLS', 10)
+        self.reset_timeout = reset_timeout or \
+            getattr(settings, 'FACEBOOK_BREAKER_RESET_TIMEOUT', 30)
+        self.calls = deque(maxlen=window or
+                           getattr(settings, 'FACEBOOK_BREAKER_WINDOW', 20))
+        self.state = self.CLOSED
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def call(self, func, *args, **kwargs):
+        """
+        Calls func unless the circuit is open. URLErrors and calls slower
+        than slow_call_time count as failures. BudgetExceededErrors don't
+        count at all, they say more about the request than about facebook.
+        """
+        self.before_call()
+        start = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except BudgetExceededError:
+            self.abandon()
+            raise
+        except URLError:
+            self.record(False, time.time() - start)
+            raise
+        except Exception:
+            self.record(True, time.time() - start)
+            raise
+        self.record(True, time.time() - start)
+        return result
+
+    def before_call(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.time() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpenError('graph API circuit is open')
+                log.info("Graph API circuit half open, probing")
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    raise CircuitOpenError('graph API circuit is half open')
+                self._probing = True
+
+    def abandon(self):
+        """forget a call that told us nothing about facebook's health"""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+
+    def record(self, success, duration):
+        ok = success and duration < self.slow_call_time
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+                if ok:
+                    log.info("Graph API circuit closed")
+                    self.state = self.CLOSED
+                    self.calls.clear()
+                else:
+                    self._open()
+                return
+            self.calls.append(ok)
+            failures = self.calls.count(False)
+            if (self.state == self.CLOSED and len(self.calls) >= self.min_calls
+                    and failures >= self.failure_rate * len(self.calls)):
+                self._open()
+
+    def _open(self):
+        log.error("Graph API circuit open")
+        self.state = self.OPEN
+        self.opened_at = time.time()
+        self.calls.clear()
+
+
+graph_breaker = CircuitBreaker()
+
+
+class LatencyBudget(object):
+    """How much time one request may still spend waiting on graph calls"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.spent = 0.0
+
+    def remaining(self):
+        return self.seconds - self.spent
+
+    def charge(self, seconds):
+        self.spent += seconds
+
+
+def start_budget(seconds):
+    """Gives this thread's graph calls a fresh budget, None turns it off"""
+    _thread_locals.budget = seconds and LatencyBudget(seconds) or None
+
+
+def get_budget():
+    return getattr(_thread_locals, 'budget', None)
@@ -0,0 +1,271 @@
+# Copyright 2008-2009 Brian Boyer, Ryan Mark, Angela Nitzke, Joshua Pollock,
+# Stuart Tiffen, Kayla Webley and the Medill School of Journalism, Northwestern
+# University.
+#
+# This file is part of django-facebookconnect.
+#
+# django-facebookconnect is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-facebookconnect is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with django-facebookconnect.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Cache helpers for facebook data.
+
+Values are stored with the time they were fetched. Once they are older than
+FACEBOOK_CACHE_TIMEOUT they are stale: still served, but refreshed in the
+background. They drop out of the cache after FACEBOOK_CACHE_HARD_TIMEOUT.
+Keys facebook had nothing for are remembered as missing for
+FACEBOOK_CACHE_MISSING_TIMEOUT seconds.
+
+Only one worker fetches or refreshes a key at a time. Everyone else asking
+for it serves the stale value or waits up to FACEBOOK_CACHE_WAIT seconds for
+the fetch, and stops waiting early once the fetch is done. Each key has its
+own lease, so batches that overlap share the keys they have in common, but
+a batch takes its leases in three cache round trips however many keys it
+has.
+"""
+
+import logging
+log = logging.getLogger('facebookconnect.caching')
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from facebookconnect.utils import BackgroundPool
+
+SOFT_TIMEOUT = getattr(settings, 'FACEBOOK_CACHE_TIMEOUT', 1800)
+HARD_TIMEOUT = getattr(settings, 'FACEBOOK_CACHE_HARD_TIMEOUT', SOFT_TIMEOUT * 4)
+MISSING_TIMEOUT = getattr(settings, 'FACEBOOK_CACHE_MISSING_TIMEOUT', 60)
+LOCK_TIMEOUT = getattr(settings, 'FACEBOOK_CACHE_LOCK_TIMEOUT', 30)
+WAIT_TIMEOUT = getattr(settings, 'FACEBOOK_CACHE_WAIT', 3)
+POLL_INTERVAL = 0.05
+
+refresh_pool = BackgroundPool(
+    getattr(settings, 'FACEBOOK_REFRESH_WORKERS', 2),
+    getattr(settings, 'FACEBOOK_REFRESH_QUEUE_SIZE', 100))
+
+
+def get_many(keys):
+    """
+    Returns two dicts of the values found for keys, the first with fresh
+    values and the second with stale ones.
+    """
+    fresh, stale, missing = _split(cache.get_many(keys))
+    return fresh, stale
+
+
+def _split(found):
+    """
+    Sorts cache entries into dicts of fresh and stale values, and a list
+    of the keys known to be missing.
+    """
+    fresh, stale, missing = {}, {}, []
+    now = time.time()
+    for key, entry in found.items():
+        if not isinstance(entry, tuple):
+            continue
+        fetched_at, value = entry
+        if value is None:
+            missing.append(key)
+        elif now - fetched_at < SOFT_TIMEOUT:
+            fresh[key] = value
+        else:
+            stale[key] = value
+    return fresh, stale, missing
+
+
+def get(key):
+    """Returns a (value, is_stale) tuple for key. value is None on a miss."""
+    fresh, stale = get_many([key])
+    if key in fresh:
+        return fresh[key], False
+    return stale.get(key), key in stale
+
+
+def set_many(data):
+    now = time.time()
+    found = dict((key, (now, value)) for key, value in data.items()
+                 if value is not None)
+    missing = dict((key, (now, None)) for key, value in data.items()
+                   if value is None)
+    if found:
+        cache.set_many(found, HARD_TIMEOUT)
+    if missing:
+        cache.set_many(missing, MISSING_TIMEOUT)
+
+
+def set(key, value):
+    set_many({key: value})
+
+
+def delete(key):
+    cache.delete(key)
+
+
+def lease_key(key):
+    """the cache key of the lock on key"""
+    return 'fb_lease_%s' % key
+
+
+def lock(keys):
+    """
+    Takes the locks on whichever of keys nobody else has, and returns
+    those keys. Three cache round trips however many keys there are: see
+    which are taken, claim the rest, and read back which claims stuck.
+    """
+    leases = dict((lease_key(key), key) for key in keys)
+    taken = cache.get_many(leases.keys())
+    free = [lease for lease in leases if lease not in taken]
+    if not free:
+        return []
+    token = '%x' % random.getrandbits(64)
+    cache.set_many(dict((lease, token) for lease in free), LOCK_TIMEOUT)
+    claimed = cache.get_many(free)
+    return [leases[lease] for lease in free if claimed.get(lease) == token]
+
+
+def unlock(keys):
+    if keys:
+        cache.delete_many([lease_key(key) for key in keys])
+
+
+def refresh_later(keys, func):
+    """
+    Refreshes the stale keys in the background by calling func with them,
+    skipping the ones someone else is already refreshing. The locks are
+    released once func is done.
+    """
+    keys = list(keys)
+    locked = lock(keys)
+    _count('refreshes_skipped', len(keys) - len(locked))
+    if not locked:
+        return
+
+    def refresh():
+        try:
+            func(locked)
+        finally:
+            unlock(locked)
+
+    log.debug("Refreshing %s in the background" % locked)
+    _count('refreshes', len(locked))
+    if not refresh_pool.submit(refresh):
+        unlock(locked)
+
+
+def get_or_fetch_many(keys, fetch):
+    """
+    Returns a dict of the values for keys. fetch is called with a list of
+    keys that need fetching and must return a dict of values for them.
+    Values fetch can't find are left out, and aren't asked for again until
+    FACEBOOK_CACHE_MISSING_TIMEOUT is up.
+    """
+    fresh, stale, known_missing = _split(cache.get_many(keys))
+    values = dict(fresh)
+    values.update(stale)
+    _count('hits', len(fresh))
+    _count('stale_hits', len(stale))
+    _count('missing_hits', len(known_missing))
+
+    if stale:
+        refresh_later(stale.keys(), lambda stale_keys: _fetch_and_set(stale_keys, fetch))
+
+    missing = [key for key in keys if key not in values and key not in known_missing]
+    if missing:
+        _count('misses', len(missing))
+        values.update(_fetch_missing(missing, fetch))
+    return values
+
+
+def get_or_fetch(key, fetch):
+    """Returns the value for key, calling fetch() for it when needed"""
+    return get_or_fetch_many([key], lambda keys: {key: fetch()}).get(key)
+
+
+def _fetch_missing(keys, fetch):
+    locked = lock(keys)
+    values = {}
+    if locked:
+        try:
+            values.update(_fetch_and_set(locked, fetch))
+        finally:
+            unlock(locked)
+
+    others = [key for key in keys if key not in locked]
+    if not others:
+        return values
+    log.debug("Waiting on someone else to fetch %s" % others)
+    found, late = _wait_for(others)
+    values.update(found)
+    _count('coalesced', len(others) - len(late))
+    if late:
+        log.debug("Gave up waiting on %s" % late)
+        _count('wait_timeouts', len(late))
+        values.update(_fetch_and_set(late, fetch))
+    return values
+
+
+def _fetch_and_set(keys, fetch):
+    """fetches keys and caches the values, and which keys fetch left out"""
+    values = dict((key, value) for key, value in fetch(keys).items()
+                  if value is not None)
+    data = dict((key, None) for key in keys)
+    data.update(values)
+    set_many(data)
+    return values
+
+
+def _wait_for(keys):
+    """
+    Waits for someone else's fetch of keys. Returns a dict of the values
+    that came in and a list of the keys that didn't, either because the
+    wait timed out or because the fetch finished without them.
+    """
+    values = {}
+    late = []
+    deadline = time.time() + WAIT_TIMEOUT
+    while keys and time.time() < deadline:
+        time.sleep(POLL_INTERVAL)
+        found = cache.get_many(keys + [lease_key(key) for key in keys])
+        fresh, stale, missing = _split(found)
+        values.update(fresh)
+        values.update(stale)
+        keys = [key for key in keys if key not in values and key not in missing]
+        # values are cached before the lock goes, so a released lock with
+        # nothing cached means the fetch failed
+        late.extend(key for key in keys if lease_key(key) not in found)
+        keys = [key for key in keys if lease_key(key) in found]
+    return values, late + keys
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+def _count(name, n=1):
+    if n:
+        with _stats_lock:
+            _stats[name] = _stats.get(name, 0) + n
+
+
+def get_stats():
+    """
+    Returns counters for this process: cache hits, stale_hits, misses and
+    missing_hits for keys facebook had nothing for, the background
+    refreshes started and refreshes_skipped because another worker had the
+    lock, and how often callers coalesced onto someone else's fetch or hit
+    wait_timeouts and fetched anyway.
+    """
+    with _stats_lock:
+        return dict(_stats)
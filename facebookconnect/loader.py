@@ -0,0 +1,271 @@
+# Copyright 2008-2009 Brian Boyer, Ryan Mark, Angela Nitzke, Joshua Pollock,
+# Stuart Tiffen, Kayla Webley and the Medill School of Journalism, Northwestern
+# University.
+#
+# This file is part of django-facebookconnect.
+#
+# django-facebookconnect is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-facebookconnect is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with django-facebookconnect.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+log = logging.getLogger('facebookconnect.loader')
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+from facebookconnect.utils import BackgroundPool, LRUCache, run_later
+
+try:
+    from threading import local
+except ImportError:
+    from django.utils._threading_local import local
+
+_thread_locals = local()
+_MISSING = object()
+
+FIELDS_TIMEOUT = 60 * 60 * 24 * 7
+
+loader_pool = BackgroundPool(
+    getattr(settings, 'FACEBOOK_LOADER_WORKERS', 4),
+    getattr(settings, 'FACEBOOK_LOADER_QUEUE_SIZE', 100))
+
+
+class ProfileLoader(object):
+    """
+    Collects the facebook ids of the profiles created during one unit of work
+    so their info can be fetched together. The middleware activates a fresh
+    loader for every request. Anywhere else (celery tasks, management
+    commands) use it as a context manager:
+
+        with ProfileLoader():
+            for profile in FacebookProfile.objects.all():
+                print profile.name
+
+    Outside of an active loader every profile fetches its own info.
+    """
+
+    def __init__(self, max_batch_size=None, max_size=None):
+        self.max_batch_size = max_batch_size or \
+            getattr(settings, 'FACEBOOK_BATCH_SIZE', 50)
+        self.max_size = max_size or \
+            getattr(settings, 'FACEBOOK_LOADER_SIZE', 1000)
+        self.pending = OrderedDict()
+        self.results = LRUCache(self.max_size)
+        # graph fields to fetch, and the ones profiles actually used
+        self.fields = None
+        self.fields_key = None
+        self.accessed_fields = set()
+        # version stamps of the info, looked up once per loader
+        self.versions = {}
+        # cached template fragments, and the kinds of fragment looked up
+        self.fragments = {}
+        self.fragment_kinds = set()
+        self._previous = None
+
+    def register(self, fbid):
+        """queue a facebook id for the next batch"""
+        if not fbid:
+            return
+        fbid = str(fbid)
+        if fbid in self.pending or fbid in self.results:
+            return
+        if len(self.pending) >= self.max_size:
+            log.debug("Loader full, not batching %s" % fbid)
+            return
+        self.pending[fbid] = True
+
+    def load(self, fbid, fetch):
+        """
+        Returns the info for fbid. If it hasn't been loaded yet, fetch is
+        called with fbid and as many pending ids as fit in one batch. fetch
+        must return a dict of info keyed by facebook id.
+        """
+        if not fbid:
+            return None
+        fbid = str(fbid)
+        info = self.results.get(fbid, _MISSING)
+        if info is not _MISSING:
+            return info
+
+        batch = [fbid]
+        for other in self.pending:
+            if len(batch) >= self.max_batch_size:
+                break
+            if other != fbid and other not in self.results:
+                batch.append(other)
+
+        all_info = fetch(batch)
+        for other in batch:
+            self.pending.pop(other, None)
+            self.results.set(other, all_info.get(other))
+        return all_info.get(fbid)
+
+    def reload(self, fbid, key, fetch):
+        """
+        Returns the info for fbid after fetching it again because it was
+        loaded without the graph field key. Other loaded ids missing key
+        are fetched in the same batch, and later loads include key.
+        fetch is called with the ids and the widened list of fields.
+        """
+        fbid = str(fbid)
+        info = self.results.get(fbid)
+        if info is not None and key in info:
+            return info
+        if self.fields is not None and key not in self.fields:
+            self.fields = sorted(set(self.fields) | set([key]))
+
+        batch = [fbid]
+        for other, other_info in reversed(self.results.items()):
+            if len(batch) >= self.max_batch_size:
+                break
+            if other != fbid and other_info is not None and key not in other_info:
+                batch.append(other)
+
+        all_info = {}
+        try:
+            all_info = fetch(batch)
+        finally:
+            for other in batch:
+                merged = dict(self.results.get(other) or {})
+                merged.update(all_info.get(other) or {})
+                # facebook may keep key to itself or fail, don't ask again
+                merged.setdefault(key, None)
+                self.results.set(other, merged)
+        return self.results.get(fbid)
+
+    def load_many(self, fbids, fetch):
+        """
+        Returns a dict of info for fbids, keyed by facebook id. fetch is
+        called once, with every id that hasn't been loaded yet.
+        """
+        all_info = {}
+        missing = []
+        for fbid in OrderedDict.fromkeys(str(fbid) for fbid in fbids if fbid):
+            info = self.results.get(fbid, _MISSING)
+            if info is _MISSING:
+                missing.append(fbid)
+            else:
+                all_info[fbid] = info
+        if missing:
+            fetched = fetch(missing)
+            for fbid in missing:
+                self.pending.pop(fbid, None)
+                self.results.set(fbid, fetched.get(fbid))
+                all_info[fbid] = fetched.get(fbid)
+        return all_info
+
+    def load_versions(self, fbids, fetch):
+        """
+        Returns a dict of the version stamps of fbids' info, keyed like
+        fbids. Stamps are remembered for the life of the loader. Ones it
+        doesn't know yet are fetched in one call, along with the stamps of
+        every pending and loaded id, so a page of cached tags looks them up
+        once. fetch is called with a list of ids and returns a dict.
+        """
+        missing = [str(fbid) for fbid in fbids
+                   if fbid and str(fbid) not in self.versions]
+        if missing:
+            batch = OrderedDict.fromkeys(missing)
+            for other in self._known_ids():
+                if other not in self.versions:
+                    batch[other] = True
+            self.versions.update(fetch(list(batch)))
+        return dict((fbid, self.versions.get(str(fbid))) for fbid in fbids if fbid)
+
+    def load_fragment(self, fbid, kind, make_keys, fetch):
+        """
+        Returns the cache key and the cached fragment of kind for fbid, or
+        None for a miss. The first time a kind of fragment is asked for, it's
+        looked up for every pending and loaded id in one call, so a page of
+        the same tag looks them up once. make_keys is called with a list of
+        ids and returns a dict of their cache keys, fetch is called with a
+        list of keys and returns a dict of the fragments found.
+        """
+        fbid = str(fbid)
+        fbids = [fbid]
+        if kind not in self.fragment_kinds:
+            self.fragment_kinds.add(kind)
+            fbids.extend(other for other in self._known_ids() if other != fbid)
+        keys = make_keys(fbids)
+        wanted = [key for key in keys.values() if key not in self.fragments]
+        if wanted:
+            found = fetch(wanted)
+            for key in wanted:
+                self.fragments[key] = found.get(key)
+        return keys[fbid], self.fragments[keys[fbid]]
+
+    def _known_ids(self):
+        return list(self.pending) + [fbid for fbid, info in self.results.items()]
+
+    def load_later(self, fbids, fetch):
+        """
+        Starts fetching the info for fbids on a background thread and returns
+        a Pending for the dict fetch returns. Once it's done, load() answers
+        from the fetched info.
+        """
+        fbids = [str(fbid) for fbid in fbids if fbid]
+
+        def fetch_all():
+            all_info = {}
+            for start in range(0, len(fbids), self.max_batch_size):
+                batch = fbids[start:start + self.max_batch_size]
+                all_info.update(fetch(batch))
+                for fbid in batch:
+                    self.results.set(fbid, all_info.get(fbid))
+            return all_info
+
+        return run_later(loader_pool, fetch_all)
+
+    def track_fields(self, name):
+        """
+        Fetch profiles with just the graph fields earlier loaders tracking
+        name have seen used. Call save_fields() when done.
+        """
+        self.fields_key = 'fb_fields_%s' % name
+        self.fields = cache.get(self.fields_key)
+
+    def save_fields(self):
+        """remember the fields used since track_fields()"""
+        if not self.fields_key or not self.accessed_fields:
+            return
+        if self.fields and self.accessed_fields <= set(self.fields):
+            return
+        fields = sorted(self.accessed_fields | set(self.fields or ()))
+        log.debug("Fields used by %s: %s" % (self.fields_key, fields))
+        cache.set(self.fields_key, fields, FIELDS_TIMEOUT)
+
+    def activate(self):
+        self._previous = getattr(_thread_locals, 'loader', None)
+        _thread_locals.loader = self
+        return self
+
+    def deactivate(self):
+        _thread_locals.loader = self._previous
+        self._previous = None
+
+    def __enter__(self):
+        return self.activate()
+
+    def __exit__(self, *exc_info):
+        self.deactivate()
+
+
+def get_profile_loader():
+    """Returns the active ProfileLoader, or None"""
+    return getattr(_thread_locals, 'loader', None)
+
+
+def set_profile_loader(loader):
+    """Replaces the active ProfileLoader, used by the middleware"""
+    _thread_locals.loader = loader
@@ -1,8 +1,16 @@
+import hashlib
+import time
 
+from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
 
 import facebook
 
+from facebookconnect.batch import GraphBatch
+from facebookconnect.transport import PooledGraphAPI
+from facebookconnect.utils import LRUCache
+
 try:
     from threading import local
 except ImportError:
@@ -10,22 +18,174 @@ except ImportError:
 
 _thread_locals = local()
 
+# verified cookies, keyed by the raw fbs_ cookie value
+_cookie_cache = LRUCache(getattr(settings, 'FACEBOOK_COOKIE_CACHE_SIZE', 1000))
+_MISSING = object()
+
 
 class LocalFacebookClient(object):
-    
-    def __init__(self, uid, access_token):
+
+    def __init__(self, uid, access_token, expires=None):
         self.uid = uid
         self.session_key = access_token # CHOP THIS
         self.access_token = access_token
-        self.graph = facebook.GraphAPI(access_token)
-        _thread_locals.facebook = self
+        self.expires = int(expires or 0)
+        self._graph = None
+        self._batch = None
+        self._me = None
+        self._me_id = None
+
+    @property
+    def graph(self):
+        """GraphAPI for this client's access token, made on first use"""
+        if self._graph is None:
+            self._graph = PooledGraphAPI(self.access_token)
+        return self._graph
+
+    @property
+    def batch(self):
+        """GraphBatch that collects this client's calls into one request"""
+        if self._batch is None:
+            self._batch = GraphBatch(self.graph)
+        return self._batch
+
+    @property
+    def me(self):
+        """the logged in user's graph object, queued on the batch"""
+        if self._me is None:
+            self._me = self.batch.get_object("me")
+        return self._me
+
+    def get_me_id(self):
+        """
+        Returns the facebook id of the user who owns our access token. The
+        answer is cached until the token expires.
+        """
+        if self._me_id is None:
+            self.prefetch_me()
+        if self._me_id is None:
+            self._me_id = self.me["id"]
+            timeout = getattr(settings, 'FACEBOOK_CACHE_TIMEOUT', 1800)
+            if self.expires:
+                timeout = min(timeout, int(self.expires - time.time()))
+            if timeout > 0:
+                cache.set(token_cache_key(self.access_token), self._me_id, timeout)
+        return self._me_id
+
+    def prefetch_me(self):
+        """
+        Looks up the owner of our access token in the cache, and queues the
+        "me" call on the batch if it isn't there.
+        """
+        if self._me_id is None and self.access_token:
+            self._me_id = cache.get(token_cache_key(self.access_token))
+            if self._me_id is None:
+                self.me
+
+    def clear_session(self):
+        """forget the facebook session, usually on logout"""
+        if self.access_token:
+            cache.delete(token_cache_key(self.access_token))
+        self._me_id = None
+        self.session_key = None
+        self.uid = None
 
     def __unicode__(self):
         return "<LocalFacebookClient: %s>" % (self.uid)
 
 
+class LazyFacebookClient(object):
+    """
+    Stands in for request.facebook. The request's cookie is verified and its
+    LocalFacebookClient built the first time any attribute is used, so
+    requests that never touch facebook don't pay for it.
+    """
+
+    def __init__(self, request):
+        self.__dict__['_request'] = request
+        self.__dict__['_client'] = None
+
+    def _get_client(self):
+        client = self._client
+        if client is None:
+            fbuser = get_facebook_session(self._request) or {}
+            client = LocalFacebookClient(fbuser.get("uid"),
+                                         fbuser.get("access_token"),
+                                         fbuser.get("expires"))
+            # if we don't know who owns the token, ask along with the first batch
+            client.prefetch_me()
+            self.__dict__['_client'] = client
+        return client
+
+    def __getattr__(self, name):
+        return getattr(self._get_client(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._get_client(), name, value)
+
+    def __unicode__(self):
+        if self._client is None:
+            return u"<LazyFacebookClient>"
+        return self._client.__unicode__()
+
+
 def get_facebook_client():
+    client = getattr(_thread_locals, 'facebook', None)
+    if client is None:
+        raise ImproperlyConfigured('Make sure you have the Facebook middleware installed.')
+    return client
+
+
+def resolve_facebook_client(client):
+    """
+    Returns the LocalFacebookClient behind client, building it now if
+    client is a LazyFacebookClient. Do this before handing a client to
+    another thread, so the request's cookie is read in the request's thread.
+    """
+    if isinstance(client, LazyFacebookClient):
+        return client._get_client()
+    return client
+
+
+def set_facebook_client(client):
+    """Sets this thread's client, None clears it at the end of a request"""
+    _thread_locals.facebook = client
+
+
+def token_cache_key(access_token):
+    return 'fb_token_uid_%s' % hashlib.sha1(access_token).hexdigest()
+
+
+def get_user_from_cookie(cookies):
+    """
+    Returns the verified facebook session stored in the fbs_ cookie, or None.
+    Verification results are remembered by raw cookie value so repeat visits
+    with the same cookie skip the signature check. Expiry is still checked
+    every time.
+    """
+    raw = cookies.get("fbs_" + settings.FACEBOOK_APP_ID, "")
+    if not raw:
+        return None
+    fbuser = _cookie_cache.get(raw, _MISSING)
+    if fbuser is _MISSING:
+        fbuser = facebook.get_user_from_cookie(cookies,
+                                               settings.FACEBOOK_APP_ID,
+                                               settings.FACEBOOK_SECRET_KEY)
+        _cookie_cache.set(raw, fbuser)
+    elif fbuser:
+        # the signature can't change, but the session can run out.
+        # expires is 0 for sessions that never do.
+        expires = int(fbuser.get("expires") or 0)
+        if expires and expires < time.time():
+            _cookie_cache.delete(raw)
+            return None
+    return fbuser
+
+
+def get_facebook_session(request):
+    """Verifies the request's facebook cookie once and shares the result"""
     try:
-        return _thread_locals.facebook
+        return request._facebook_session
     except AttributeError:
-        raise ImproperlyConfigured('Make sure you have the Facebook middleware installed.')
\ No newline at end of file
+        request._facebook_session = get_user_from_cookie(request.COOKIES)
+        return request._facebook_session
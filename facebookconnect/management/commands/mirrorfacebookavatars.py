@@ -0,0 +1,62 @@
+# Copyright 2008-2009 Brian Boyer, Ryan Mark, Angela Nitzke, Joshua Pollock,
+# Stuart Tiffen, Kayla Webley and the Medill School of Journalism, Northwestern
+# University.
+#
+# This file is part of django-facebookconnect.
+#
+# django-facebookconnect is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-facebookconnect is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with django-facebookconnect.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+from optparse import make_option
+from urllib2 import URLError
+
+from django.core.management import BaseCommand, CommandError
+from facebookconnect.mirror import get_mirror
+from facebookconnect.models import FacebookProfile
+from facebookconnect.pictures import SIZES
+
+class Command(BaseCommand):
+    args = '[facebook_id ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--size', action='append', dest='sizes', choices=SIZES,
+                    help='Picture size to mirror, can be repeated. Default is square.'),
+        make_option('--refresh', action='store_true', dest='refresh', default=False,
+                    help='Download pictures that are already mirrored, too.'),
+    )
+
+    def handle(self,*args,**options):
+        """Download the pictures of the given profiles, or all of them, into the avatar mirror"""
+        mirror = get_mirror()
+        if mirror is None:
+            raise CommandError('Set FACEBOOK_AVATAR_MIRROR to turn on the avatar mirror.')
+        if args:
+            fbids = list(args)
+        else:
+            fbids = FacebookProfile.objects.values_list('facebook_id', flat=True)
+        sizes = options.get('sizes') or ['square']
+        mirrored = missing = failed = 0
+        for fbid in fbids:
+            for size in sizes:
+                if not options.get('refresh') and os.path.exists(mirror.path(fbid, size)):
+                    continue
+                try:
+                    if mirror.fetch(fbid, size) is None:
+                        missing += 1
+                    else:
+                        mirrored += 1
+                except URLError, ex:
+                    print "Couldn't get the %s picture for %s: %s" % (size, fbid, ex)
+                    failed += 1
+        print "Mirrored %i pictures, %i missing on facebook, %i failed" % (
+            mirrored, missing, failed)
@@ -0,0 +1,45 @@
+# Copyright 2008-2009 Brian Boyer, Ryan Mark, Angela Nitzke, Joshua Pollock,
+# Stuart Tiffen, Kayla Webley and the Medill School of Journalism, Northwestern
+# University.
+#
+# This file is part of django-facebookconnect.
+#
+# django-facebookconnect is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-facebookconnect is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with django-facebookconnect.  If not, see <http://www.gnu.org/licenses/>.
+
+from urllib2 import URLError
+
+import facebook
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from facebookconnect.localfb import LocalFacebookClient
+from facebookconnect.models import FacebookProfile, FacebookFriendEdge
+
+class Command(BaseCommand):
+    args = '[facebook_id ...]'
+
+    def handle(self,*args,**options):
+        """Refetch the friend lists of the given profiles, or all of them, into the friend index"""
+        if args:
+            fbids = list(args)
+        else:
+            fbids = FacebookProfile.objects.values_list('facebook_id', flat=True)
+        # an app access token can read the friends of the app's users
+        client = LocalFacebookClient(None, "%s|%s" % (settings.FACEBOOK_APP_ID,
+                                                      settings.FACEBOOK_SECRET_KEY))
+        for fbid in fbids:
+            try:
+                FacebookFriendEdge.objects.refresh(fbid, client)
+            except (facebook.GraphAPIError, URLError), ex:
+                print "Failed refreshing friends of %s: %s" % (fbid, ex)
@@ -19,9 +19,11 @@
 
 import logging
 log = logging.getLogger('facebookconnect.middleware')
+import re
 import warnings
 from datetime import datetime
 from urllib2 import URLError
+from urlparse import urlparse
 
 from django.core.urlresolvers import reverse
 from django.contrib.auth import logout,login
@@ -29,31 +31,71 @@ from django.conf import settings
 from django.template import TemplateSyntaxError
 from django.http import HttpResponseRedirect,HttpResponse
 
-from facebookconnect.models import FacebookProfile
-from facebookconnect.localfb import LocalFacebookClient
+from facebookconnect.models import FacebookProfile, get_user_profile
+from facebookconnect.breaker import start_budget
+from facebookconnect.localfb import LazyFacebookClient, get_facebook_session, \
+    set_facebook_client
+from facebookconnect.loader import ProfileLoader, get_profile_loader, set_profile_loader
 import facebook
 
-import threading
 
-try:
-    from threading import local
-except ImportError:
-    from django.utils._threading_local import local
+def _compile_excluded_paths():
+    """
+    Builds one regex out of MEDIA_URL, STATIC_URL and FACEBOOK_EXCLUDED_PATHS.
+    Entries starting with ^ are regexes, anything else is a path prefix.
+    """
+    paths = [getattr(settings, 'MEDIA_URL', None),
+             getattr(settings, 'STATIC_URL', None)]
+    paths.extend(getattr(settings, 'FACEBOOK_EXCLUDED_PATHS', ()))
+    patterns = []
+    for path in paths:
+        if not path:
+            continue
+        if path.startswith('^'):
+            patterns.append('(?:%s)' % path)
+            continue
+        # MEDIA_URL can be a full url, we only care about its path
+        path = urlparse(path).path
+        if path and path != '/':
+            patterns.append(re.escape(path))
+    if not patterns:
+        return None
+    return re.compile('|'.join(patterns))
+
+_excluded_paths = _compile_excluded_paths()
 
-_thread_locals = local()
+def is_excluded_path(path):
+    """True if requests for path should skip facebook entirely"""
+    return _excluded_paths is not None and _excluded_paths.match(path) is not None
 
 
 class FacebookMiddleware(object):
     """Port of the FacebookMiddleware from pyfacebook"""
     
     def process_request(self,request):
-        fbuser = facebook.get_user_from_cookie(request.COOKIES, 
-                                               settings.FACEBOOK_APP_ID, 
-                                               settings.FACEBOOK_SECRET_KEY)
-        
-        uid = fbuser.get("uid") if fbuser else None
-        access_token = fbuser.get("access_token") if fbuser else None
-        request.facebook = LocalFacebookClient(uid, access_token)
+        request.facebook_excluded = is_excluded_path(request.path)
+        if request.facebook_excluded:
+            return None
+        start_budget(getattr(settings, 'FACEBOOK_GRAPH_REQUEST_BUDGET', None))
+        request.facebook = LazyFacebookClient(request)
+        set_facebook_client(request.facebook)
+
+    def process_response(self,request,response):
+        if not getattr(request, 'facebook_excluded', False):
+            start_budget(None)
+            set_facebook_client(None)
+        return response
+
+
+class LazyFacebookProfile(object):
+    """request.facebook_profile: the user's FacebookProfile, or None"""
+    def __get__(self, request, obj_type=None):
+        if request is None:
+            # looked up on the class, so hasattr(request.__class__, ...) works
+            return self
+        if not hasattr(request, '_cached_facebook_profile'):
+            request._cached_facebook_profile = get_user_profile(request.user)
+        return request._cached_facebook_profile
 
 
 class FacebookConnectMiddleware(object):
@@ -61,50 +103,62 @@ class FacebookConnectMiddleware(object):
     def process_request(self,request):
         """process incoming request"""
         
-        # clear out the storage of fb ids in the local thread
-        if hasattr(_thread_locals,'fbids'):
-            del _thread_locals.fbids
+        request.__class__.facebook_profile = LazyFacebookProfile()
+        if is_excluded_path(request.path):
+            return None
+        
+        # start a fresh batch of fb ids for this request
+        set_profile_loader(ProfileLoader())
 
         try:
             # This is true if anyone has ever used the browser to log in to
             # facebook with an acount that has accepted this application.
-            fbuser = facebook.get_user_from_cookie(request.COOKIES, 
-                                                   settings.FACEBOOK_APP_ID, 
-                                                   settings.FACEBOOK_SECRET_KEY)
+            fbuser = get_facebook_session(request)
             bona_fide = fbuser != None
             uid = fbuser["uid"] if fbuser else None
-            if not request.path.startswith(settings.MEDIA_URL):
-                log.debug("Bona Fide: %s, Logged in: %s" % (bona_fide, uid))
+            log.debug("Bona Fide: %s, Logged in: %s" % (bona_fide, uid))
             
             if not bona_fide or not uid:
                 # we have no fb info, so we shouldn't have a fb only
                 # user logged in
                 user = request.user
-                if user.is_authenticated() and bona_fide:
-                    try:
-                        fbp = FacebookProfile.objects.get(user=user)
-
-                        if fbp.facebook_only():
-                            cur_user = fbuser["uid"]
-                            if int(cur_user) != int(request.facebook.uid):
-                                logout(request)
-                                request.facebook.session_key = None
-                                request.facebook.uid = None
-                    except FacebookProfile.DoesNotExsist, ex:
-                        # user doesnt have facebook :(
-                        pass
+                if bona_fide and user.is_authenticated():
+                    fbp = request.facebook_profile
+                    # if fbp is None the user doesnt have facebook :(
+                    if fbp is not None and fbp.facebook_only():
+                        cur_user = fbuser["uid"]
+                        if int(cur_user) != int(request.facebook.uid):
+                            logout(request)
+                            request._cached_facebook_profile = None
+                            request.facebook.clear_session()
 
         except Exception, ex:
             # Because this is a middleware, we can't assume the errors will
             # be caught anywhere useful.
             logout(request)
+            request._cached_facebook_profile = None
             if hasattr(request, 'facebook'):
-              request.facebook.session_key = None
-              request.facebook.uid = None
+              request.facebook.clear_session()
             log.exception(ex)
 
         return None
 
+    def process_view(self,request,view_func,view_args,view_kwargs):
+        if getattr(settings, 'FACEBOOK_TRACK_FIELDS', False):
+            loader = get_profile_loader()
+            if loader is not None:
+                loader.track_fields('%s.%s' % (view_func.__module__,
+                                               getattr(view_func, '__name__',
+                                                       view_func.__class__.__name__)))
+        return None
+
+    def process_response(self,request,response):
+        loader = get_profile_loader()
+        if loader is not None:
+            loader.save_fields()
+        set_profile_loader(None)
+        return response
+
     def process_exception(self,request,exception):
         my_ex = exception
         if type(exception) == TemplateSyntaxError:
@@ -114,10 +168,10 @@ class FacebookConnectMiddleware(object):
         if type(my_ex) == facebook.GraphAPIError:
             # we get this error if the facebook session is timed out
             # we should log out the user and send them to somewhere useful
-            if my_ex.type is "OAuthException":
+            if my_ex.type == "OAuthException":
                 logout(request)
-                request.facebook.session_key = None
-                request.facebook.uid = None
+                request._cached_facebook_profile = None
+                request.facebook.clear_session()
                 log.error(my_ex.type, my_ex.message)
                 return HttpResponseRedirect(reverse('facebookconnect.views.facebook_login'))
         elif type(my_ex) == URLError:
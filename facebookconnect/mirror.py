@@ -0,0 +1,221 @@
+# Copyright 2008-2009 Brian Boyer, Ryan Mark, Angela Nitzke, Joshua Pollock,
+# Stuart Tiffen, Kayla Webley and the Medill School of Journalism, Northwestern
+# University.
+#
+# This file is part of django-facebookconnect.
+#
+# django-facebookconnect is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-facebookconnect is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with django-facebookconnect.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A local copy of facebook profile pictures.
+
+With FACEBOOK_AVATAR_MIRROR set to a directory, pictures are downloaded
+into it by a few background threads, or ahead of time by the
+mirrorfacebookavatars command, and served by the facebook_avatar view.
+The directory is kept under FACEBOOK_AVATAR_MIRROR_SIZE bytes by deleting
+the pictures that were served least recently.
+
+Downloads go through facebookconnect.pictures, so pointing
+FACEBOOK_GRAPH_URL at a stub server works here too, and ids facebook has
+no picture for are remembered the same way.
+"""
+
+import logging
+log = logging.getLogger('facebookconnect.mirror')
+import os
+import tempfile
+import threading
+import time
+from urllib2 import URLError
+
+from django.conf import settings
+
+from facebookconnect.pictures import SIZES, fetch_picture, is_missing, \
+    remember_missing
+from facebookconnect.utils import BackgroundPool
+
+# what's left after the mirror gets too big, as a share of max_bytes
+EVICT_TO = 0.9
+
+CONTENT_TYPES = (
+    ('\xff\xd8', 'image/jpeg'),
+    ('GIF8', 'image/gif'),
+    ('\x89PNG', 'image/png'),
+)
+
+
+class AvatarMirror(object):
+    """
+    Profile pictures on disk, one file per facebook id and size, under
+    root/<size>/<facebook id>. A file's mtime is when it was downloaded and
+    its atime is when it was last served.
+    """
+
+    def __init__(self, root, max_bytes=None, pool=None):
+        self.root = root
+        self.max_bytes = max_bytes or \
+            getattr(settings, 'FACEBOOK_AVATAR_MIRROR_SIZE', 100 * 1024 * 1024)
+        self.pool = pool or BackgroundPool(
+            getattr(settings, 'FACEBOOK_AVATAR_MIRROR_WORKERS', 2),
+            getattr(settings, 'FACEBOOK_AVATAR_MIRROR_QUEUE_SIZE', 100))
+        self._size = None
+        self._fetching = set()
+        self._lock = threading.Lock()
+
+    def path(self, fbid, size='square'):
+        return os.path.join(self.root, size, str(fbid))
+
+    def get(self, fbid, size='square'):
+        """
+        Returns the path and os.stat of fbid's picture and marks it used, or
+        (None, None) if it hasn't been downloaded.
+        """
+        path = self.path(fbid, size)
+        try:
+            stat = os.stat(path)
+            os.utime(path, (time.time(), stat.st_mtime))
+        except OSError:
+            return None, None
+        return path, stat
+
+    def fetch(self, fbid, size='square'):
+        """
+        download fbid's picture now, returns its path, or None if facebook
+        has no picture for fbid
+        """
+        picture = fetch_picture(fbid, size)
+        if picture is None:
+            remember_missing(fbid, size)
+            return None
+        content_type, data, etag = picture
+        return self.store(fbid, size, data)
+
+    def fetch_later(self, fbid, size='square'):
+        """
+        download fbid's picture on a background thread, unless facebook
+        just said it has none
+        """
+        if is_missing(fbid, size):
+            return
+        key = (str(fbid), size)
+        with self._lock:
+            if key in self._fetching:
+                return
+            self._fetching.add(key)
+        if not self.pool.submit(self._fetch_once, key):
+            self._fetching.discard(key)
+
+    def _fetch_once(self, key):
+        try:
+            if self.fetch(*key) is None:
+                log.debug('No picture to mirror for %s' % key[0])
+        except URLError, ex:
+            log.error('Fail mirroring picture for %s: %s' % (key[0], ex))
+        finally:
+            self._fetching.discard(key)
+
+    def store(self, fbid, size, data):
+        """save a picture, evicting old ones if the mirror got too big"""
+        path = self.path(fbid, size)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # another thread or process just made it
+                pass
+        # write to a temp file first so nobody serves half a picture
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        os.chmod(tmp_path, 0644)
+        try:
+            replaced = os.stat(path).st_size
+        except OSError:
+            replaced = 0
+        os.rename(tmp_path, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = self.disk_usage()
+            else:
+                self._size += len(data) - replaced
+            if self._size > self.max_bytes:
+                self._size = self.evict(int(self.max_bytes * EVICT_TO))
+        return path
+
+    def disk_usage(self):
+        return sum(size for atime, size, path in self._files())
+
+    def evict(self, max_bytes):
+        """
+        Deletes the least recently used pictures until the mirror fits in
+        max_bytes, returns how big it is now.
+        """
+        files = sorted(self._files())
+        total = sum(size for atime, size, path in files)
+        for atime, size, path in files:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        log.debug("Avatar mirror is down to %s bytes" % total)
+        return total
+
+    def _files(self):
+        for size in SIZES:
+            directory = os.path.join(self.root, size)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield stat.st_atime, stat.st_size, path
+
+
+def content_type(path):
+    """works out a mirrored picture's content type from its first bytes"""
+    f = open(path, 'rb')
+    try:
+        head = f.read(4)
+    finally:
+        f.close()
+    for magic, mime in CONTENT_TYPES:
+        if head.startswith(magic):
+            return mime
+    return 'application/octet-stream'
+
+
+_mirror = None
+_mirror_lock = threading.Lock()
+
+def get_mirror():
+    """Returns the process's AvatarMirror, or None if it's turned off"""
+    global _mirror
+    root = getattr(settings, 'FACEBOOK_AVATAR_MIRROR', None)
+    if not root:
+        return None
+    if _mirror is None:
+        with _mirror_lock:
+            if _mirror is None:
+                _mirror = AvatarMirror(root)
+    return _mirror
@@ -18,43 +18,52 @@
 #along with django-facebookconnect.  If not, see <http://www.gnu.org/licenses/>.
 
 import datetime
+import hashlib
 import logging
 log = logging.getLogger('facebookconnect.models')
 import random
+import time
+from itertools import islice
+from urllib import urlencode
 from urllib2 import URLError
-from urlparse import urlparse
+from urlparse import parse_qsl, urlparse
 
 import facebook
 
-from django.db import models
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import Q
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
-from django.db.models.signals import post_delete
+from django.db.models.signals import post_delete, post_save
+from django.utils import simplejson
 
-from facebookconnect.localfb import get_facebook_client
+from facebookconnect import caching
+from facebookconnect.localfb import LocalFacebookClient, get_facebook_client, \
+    get_facebook_session, resolve_facebook_client
+from facebookconnect.loader import ProfileLoader, get_profile_loader
+from facebookconnect.pictures import picture_url
 
-import threading
-
-try:
-    from threading import local
-except ImportError:
-    from django.utils._threading_local import local
-
-_thread_locals = local()
+SNAPSHOTS = getattr(settings, 'FACEBOOK_PROFILE_SNAPSHOTS', False)
+FRIEND_INDEX = getattr(settings, 'FACEBOOK_FRIEND_INDEX', False)
+USER_CACHE_TIMEOUT = getattr(settings, 'FACEBOOK_USER_CACHE_TIMEOUT', None)
+INVITE_CACHE_TIMEOUT = getattr(settings, 'FACEBOOK_INVITE_CACHE_TIMEOUT',
+                               getattr(settings, 'FACEBOOK_CACHE_TIMEOUT', 1800))
+INVITE_RETRY_TIMEOUT = getattr(settings, 'FACEBOOK_INVITE_RETRY_TIMEOUT', 60)
 
 
 class FacebookBackend:
     def authenticate(self, request=None):
-        user = facebook.get_user_from_cookie(request.COOKIES, 
-                                             settings.FACEBOOK_APP_ID, 
-                                             settings.FACEBOOK_SECRET_KEY)
+        user = get_facebook_session(request)
         if user:
             try:
                 log.debug("Checking for Facebook Profile %s..." % user["uid"])
-                fbprofile = FacebookProfile.objects.get(facebook_id=user["uid"])
-                return fbprofile.user
+                fbuser = self.__get_user(user["uid"])
+                if FRIEND_INDEX and getattr(request, 'facebook', None):
+                    FacebookFriendEdge.objects.refresh_later(user["uid"],
+                                                             request.facebook)
+                return fbuser
             except FacebookProfile.DoesNotExist:
                 log.debug("FB account hasn't been used before...")
                 return None
@@ -64,6 +73,20 @@ class FacebookBackend:
         else:
             log.debug("Invalid Facebook login")
             return None
+
+    def __get_user(self, uid):
+        """
+        The user for facebook id uid. With FACEBOOK_USER_CACHE_TIMEOUT set,
+        the user's id is cached so we can skip the profile lookup.
+        """
+        if USER_CACHE_TIMEOUT:
+            user_id = cache.get(user_cache_key(uid))
+            if user_id is not None:
+                return User.objects.get(pk=user_id)
+        fbprofile = FacebookProfile.objects.select_related('user').get(facebook_id=uid)
+        if USER_CACHE_TIMEOUT:
+            cache.set(user_cache_key(uid), fbprofile.user_id, USER_CACHE_TIMEOUT)
+        return fbprofile.user
         
     def get_user(self, user_id):
         try:
@@ -82,6 +105,66 @@ class BigIntegerField(models.IntegerField):
         else:
             return "bigint"
 
+_requested_fields = set(getattr(settings, 'FACEBOOK_PROFILE_FIELDS', ()))
+
+def register_facebook_fields(*names):
+    """
+    Tell facebookconnect which graph fields your project uses. Once any
+    are registered, profiles are fetched with just those fields instead of
+    the whole graph object. FACEBOOK_PROFILE_FIELDS registers them from
+    settings.
+    """
+    _requested_fields.update(names)
+
+def get_profile_fields():
+    """
+    The graph fields to fetch profiles with, or None to fetch whole objects.
+    Registered fields win. Otherwise, with FACEBOOK_TRACK_FIELDS on, it's
+    the fields the current view has been seen to use.
+    """
+    fields = _requested_fields
+    if not fields:
+        loader = get_profile_loader()
+        fields = loader and loader.fields
+    if not fields:
+        return None
+    return sorted(set(fields) | set(['id']))
+
+class FacebookField(object):
+    """
+    A FacebookProfile attribute read from the profile's facebook info, or
+    from DUMMY_FACEBOOK_INFO when that's missing. The value is worked out
+    on first access and remembered by the profile.
+    """
+    def __init__(self, key, raw=False):
+        self.key = key
+        self.raw = raw
+
+    def __get__(self, profile, owner):
+        if profile is None:
+            return self
+        values = profile.__dict__.setdefault('_facebook_values', {})
+        try:
+            return values[self.key]
+        except KeyError:
+            value = values[self.key] = self.resolve(profile)
+            return value
+
+    def resolve(self, profile):
+        loader = get_profile_loader()
+        if loader is not None:
+            loader.accessed_fields.add(self.key)
+        info = profile._get_facebook_info()
+        if info and self.key not in info and get_profile_fields():
+            # fetched with just the fields seen so far, go back for this one
+            # rather than show dummy info
+            info = profile._reload_facebook_info(self.key) or info
+        if info and info.get(self.key):
+            if self.raw:
+                return info[self.key]
+            return u"%s" % info[self.key]
+        return profile.DUMMY_FACEBOOK_INFO.get(self.key)
+
 class FacebookTemplate(models.Model):
     name = models.SlugField(unique=True)
     template_bundle_id = BigIntegerField()
@@ -89,9 +172,29 @@ class FacebookTemplate(models.Model):
     def __unicode__(self):
         return self.name.capitalize()
 
+class FacebookProfileManager(models.Manager):
+    def for_facebook_ids(self, fbids):
+        """
+        Returns the profiles for fbids, with their users, in the order of
+        fbids, and a list of the ids that have no profile. Profiles are
+        looked up FACEBOOK_QUERY_CHUNK_SIZE ids per query.
+        """
+        chunk_size = getattr(settings, 'FACEBOOK_QUERY_CHUNK_SIZE', 500)
+        fbids = [str(fbid) for fbid in fbids]
+        found = {}
+        for start in range(0, len(fbids), chunk_size):
+            chunk = fbids[start:start + chunk_size]
+            for profile in self.select_related('user').filter(facebook_id__in=chunk):
+                found[str(profile.facebook_id)] = profile
+        profiles = [found[fbid] for fbid in fbids if fbid in found]
+        missing = [fbid for fbid in fbids if fbid not in found]
+        return profiles, missing
+
 class FacebookProfile(models.Model):
     user = models.OneToOneField(User,related_name="facebook_profile")
     facebook_id = BigIntegerField(unique=True)
+
+    objects = FacebookProfileManager()
     
     __facebook_info = None
     dummy = True
@@ -115,173 +218,61 @@ class FacebookProfile(models.Model):
         except AttributeError:
             pass
         
-        if hasattr(_thread_locals,'fbids'):
-            if ( self.facebook_id 
-                    and self.facebook_id not in _thread_locals.fbids ):
-                _thread_locals.fbids.append(str(self.facebook_id))
-        else: _thread_locals.fbids = [self.facebook_id]
-    
-    
-    def __get_first_name(self):
-        if self.__configure_me() and self.__facebook_info["first_name"]:
-            return u"%s" % self.__facebook_info["first_name"]
-        else:
-            return self.DUMMY_FACEBOOK_INFO["first_name"]
-    first_name = property(__get_first_name)
-
-    def __get_last_name(self):
-        if self.__configure_me() and self.__facebook_info["last_name"]:
-            return u"%s" % self.__facebook_info["last_name"]
-        else:
-            return self.DUMMY_FACEBOOK_INFO["last_name"]
-    last_name = property(__get_last_name)
-    
-    def __get_name(self):
-        if self.__configure_me() and self.__facebook_info["name"]:
-            return u"%s" % self.__facebook_info["name"]
-        else:
-            return self.DUMMY_FACEBOOK_INFO["name"]
-    name = property(__get_name)
-    full_name = property(__get_name)
-    
-    def __get_link(self):
-        if self.__configure_me() and self.__facebook_info["link"]:
-            return u"%s" % self.__facebook_info["link"]
-        else:
-            return self.DUMMY_FACEBOOK_INFO["link"]
-    link = property(__get_link)
+        self._loaded_facebook_id = self.facebook_id
         
-    def __get_about(self):
-        if self.__configure_me() and self.__facebook_info["about"]:
-            return u"%s" % self.__facebook_info["about"]
-        else:
-            return self.DUMMY_FACEBOOK_INFO["about"]
-    about = property(__get_about)
-
-    def __get_birthday(self):
-        if self.__configure_me() and self.__facebook_info["birthday"]:
-            return u"%s" % self.__facebook_info["birthday"]
-        else:
-            return self.DUMMY_FACEBOOK_INFO["birthday"]
-    birthday = property(__get_birthday)
-    
-    def __get_work(self):
-        if self.__configure_me() and self.__facebook_info["work"]:
-            return u"%s" % self.__facebook_info["work"]
-        else:
-            return self.DUMMY_FACEBOOK_INFO["work"]
-    work = property(__get_work)
-
-    def __get_education(self):
-        if self.__configure_me() and self.__facebook_info["education"]:
-            return u"%s" % self.__facebook_info["education"]
-        else:
-            return self.DUMMY_FACEBOOK_INFO["education"]
-    education = property(__get_education)
-    
-    def __get_email(self):
-        if self.__configure_me() and self.__facebook_info["email"]:
-            return u"%s" % self.__facebook_info["email"]
-        else:
-            return self.DUMMY_FACEBOOK_INFO["email"]
-    email = property(__get_email)
-    
-    def __get_website(self):
-        if self.__configure_me() and self.__facebook_info["website"]:
-            return u"%s" % self.__facebook_info["website"]
-        else:
-            return self.DUMMY_FACEBOOK_INFO["website"]
-    website = property(__get_website)
-
-    def __get_hometown(self):
-        if self.__configure_me() and self.__facebook_info["hometown"]:
-            return u"%s" % self.__facebook_info["hometown"]
-        else:
-            return self.DUMMY_FACEBOOK_INFO["hometown"]
-    hometown = property(__get_hometown)
-
-    def __get_location(self):
-        if self.__configure_me() and self.__facebook_info["location"]:
-            return u"%s" % self.__facebook_info["location"]
-        else:
-            return self.DUMMY_FACEBOOK_INFO["location"]
-    location = property(__get_location)
-
-    def __get_gender(self):
-        if self.__configure_me() and self.__facebook_info["gender"]:
-            return u"%s" % self.__facebook_info["gender"]
-        else:
-            return self.DUMMY_FACEBOOK_INFO["gender"]
-    gender = property(__get_gender)
-
-    def __get_interested_in(self):
-        if self.__configure_me() and self.__facebook_info["interested_in"]:
-            return self.__facebook_info["interested_in"]
-        else:
-            return self.DUMMY_FACEBOOK_INFO["interested_in"]
-    interested_in = property(__get_interested_in)
+        loader = get_profile_loader()
+        if loader is not None:
+            loader.register(self.facebook_id)
     
-    def __get_meeting_for(self):
-        if self.__configure_me() and self.__facebook_info["meeting_for"]:
-            return self.__facebook_info["meeting_for"]
-        else:
-            return self.DUMMY_FACEBOOK_INFO["meeting_for"]
-    meeting_for = property(__get_meeting_for)
-
-    def __get_relationship_status(self):
-        if self.__configure_me() and self.__facebook_info["relationship_status"]:
-            return u"%s" % self.__facebook_info["relationship_status"]
-        else:
-            return self.DUMMY_FACEBOOK_INFO["relationship_status"]
-    relationship_status = property(__get_relationship_status)
-
-    def __get_religion(self):
-        if self.__configure_me() and self.__facebook_info["religion"]:
-            return u"%s" % self.__facebook_info["religion"]
-        else:
-            return self.DUMMY_FACEBOOK_INFO["religion"]
-    religion = property(__get_religion)
     
-    def __get_political(self):
-        if self.__configure_me() and self.__facebook_info["political"]:
-            return u"%s" % self.__facebook_info["political"]
-        else:
-            return self.DUMMY_FACEBOOK_INFO["political"]
-    political = property(__get_political)
-
-    def __get_verified(self):
-        if self.__configure_me() and self.__facebook_info["verified"]:
-            return u"%s" % self.__facebook_info["verified"]
-        else:
-            return self.DUMMY_FACEBOOK_INFO["verified"]
-    verified = property(__get_verified)
-
-    def __get_significant_other(self):
-        if self.__configure_me() and self.__facebook_info["significant_other"]:
-            return u"%s" % self.__facebook_info["significant_other"]
-        else:
-            return self.DUMMY_FACEBOOK_INFO["significant_other"]
-    significant_other = property(__get_significant_other)
-    
-    def __get_timezone(self):
-        if self.__configure_me() and self.__facebook_info["timezone"]:
-            return u"%s" % self.__facebook_info["timezone"]
-        else:
-            return self.DUMMY_FACEBOOK_INFO["timezone"]
-    timezone = property(__get_timezone)
+    first_name = FacebookField('first_name')
+    last_name = FacebookField('last_name')
+    name = FacebookField('name')
+    full_name = FacebookField('name')
+    link = FacebookField('link')
+    about = FacebookField('about')
+    birthday = FacebookField('birthday')
+    work = FacebookField('work')
+    education = FacebookField('education')
+    email = FacebookField('email')
+    website = FacebookField('website')
+    hometown = FacebookField('hometown')
+    location = FacebookField('location')
+    gender = FacebookField('gender')
+    interested_in = FacebookField('interested_in', raw=True)
+    meeting_for = FacebookField('meeting_for', raw=True)
+    relationship_status = FacebookField('relationship_status')
+    religion = FacebookField('religion')
+    political = FacebookField('political')
+    verified = FacebookField('verified')
+    significant_other = FacebookField('significant_other')
+    timezone = FacebookField('timezone')
     
     def __get_username(self):
-        return self.facebook_id if "profile.php" in self.link else urlparse(self.link).path.split("/")[1]
+        if not self.link or "profile.php" in self.link:
+            return self.facebook_id
+        return urlparse(self.link).path.split("/")[1]
     username = property(__get_username)
     
     def __get_picture_url(self):
-       _facebook_obj = get_facebook_client()
-       if self.__configure_me():
-           return "https://graph.facebook.com/me/picture?access_token=%s" % _facebook_obj.access_token
-       else:
-           return self.DUMMY_FACEBOOK_INFO['pic_square_with_logo']
+        if self.facebook_id:
+            return picture_url(self.facebook_id)
+        return self.DUMMY_FACEBOOK_INFO['pic_square_with_logo']
     picture_url = property(__get_picture_url)
     
+    def _get_facebook_info(self):
+        """returns this profile's facebook info, or None"""
+        if self.__configure_me():
+            return self.__facebook_info
+        return None
+
+    def _set_facebook_info(self, info):
+        """use info fetched elsewhere, see prefetch_facebook_profiles"""
+        if info:
+            self.__facebook_info = info
+            self.dummy = False
+            self.__dict__.pop('_facebook_values', None)
+
     def facebook_only(self):
         """return true if this user uses facebook and only facebook"""
         if self.facebook_id and str(self.facebook_id) == self.user.username:
@@ -293,8 +284,7 @@ class FacebookProfile(models.Model):
         """Check if this fb user is logged in"""
         _facebook_obj = get_facebook_client()
         if _facebook_obj.access_token and _facebook_obj.uid:
-            my_profile = _facebook_obj.graph.get_object("me")
-            fbid = my_profile["id"]
+            fbid = _facebook_obj.get_me_id()
             if int(self.facebook_id) == int(fbid):
                 return True
             else:
@@ -303,105 +293,108 @@ class FacebookProfile(models.Model):
             return False
 
     def get_friends_profiles(self,limit=50):
-        '''returns profile objects for this persons facebook friends'''
+        '''returns profile objects for up to limit of this persons facebook friends'''
         friends = []
-        friends_info = []
-        friends_ids = []
         try:
-            friends_ids = self.__get_facebook_friends()
-        except (FacebookError,URLError), ex:
+            friends.extend(self.iter_friends(limit=limit))
+        except (facebook.GraphAPIError,URLError), ex:
             log.error("Fail getting friends: %s" % ex)
-        log.debug("Friends of %s %s" % (self.facebook_id,friends_ids))
-        if len(friends_ids) > 0:
-            #this will cache all the friends in one api call
-            self.__get_facebook_info(friends_ids)
-        for id in friends_ids:
-            try:
-                friends.append(FacebookProfile.objects.get(facebook_id=id))
-            except (User.DoesNotExist, FacebookProfile.DoesNotExist):
-                log.error("Can't find friend profile %s" % id)
         return friends
 
-    def __get_facebook_friends(self):
-        """returns an array of the user's friends' fb ids"""
+    def iter_friends(self, page_size=None, limit=None):
+        """
+        Yields the profiles of this person's facebook friends who use this
+        site, one page of page_size friends at a time, stopping after limit
+        profiles. Only the pages that are used get fetched from facebook.
+        With FACEBOOK_FRIEND_INDEX on, friends come from the local friend
+        index instead once it has been filled in.
+        """
+        if FRIEND_INDEX and FacebookFriendEdge.objects.filter(uid1=self.facebook_id).exists():
+            friends = FacebookFriendEdge.objects.friend_profiles(self.facebook_id)
+            if limit is not None:
+                friends = friends[:limit]
+            for friend in friends.iterator():
+                yield friend
+            return
+
+        count = 0
+        for friends_ids in self.__iter_facebook_friends(page_size):
+            log.debug("Friends of %s %s" % (self.facebook_id,friends_ids))
+            friends, missing = FacebookProfile.objects.for_facebook_ids(friends_ids)
+            if missing:
+                log.error("Can't find friend profiles %s" % missing)
+            if limit is not None:
+                friends = friends[:limit - count]
+            if friends and get_profile_loader() is None:
+                #this will cache the page of friends in one api call
+                self.__get_facebook_info([friend.facebook_id for friend in friends])
+            for friend in friends:
+                yield friend
+            count += len(friends)
+            if limit is not None and count >= limit:
+                return
+
+    def __iter_facebook_friends(self, page_size=None):
+        """
+        Yields pages of the ids of the user's friends who use this app.
+        Facebook picks out the app users, so a user with thousands of
+        friends but a few on the site takes one call. Each page is cached
+        on its own under fb_app_friends_<id>_<page size>_<page>.
+        """
         _facebook_obj = get_facebook_client()
-        friends = []
-        cache_key = 'fb_friends_%s' % (self.facebook_id)
-    
-        fb_info_cache = cache.get(cache_key)
-        if fb_info_cache:
-            friends = fb_info_cache
-        else:
-            log.debug("Calling for '%s'" % cache_key)
-            friends = _facebook_obj.friends.getAppUsers()
-            cache.set(
-                cache_key, 
-                friends, 
-                getattr(settings,'FACEBOOK_CACHE_TIMEOUT',1800)
-            )
-        
-        return friends        
+        page_size = page_size or getattr(settings, 'FACEBOOK_FRIENDS_PAGE_SIZE', 100)
+        page_number = 0
+        while True:
+            cache_key = 'fb_app_friends_%s_%s_%s' % (self.facebook_id, page_size, page_number)
+            ids = caching.get_or_fetch(cache_key,
+                lambda offset=page_number * page_size:
+                    self.__fetch_friends_page(_facebook_obj, offset, page_size))
+            yield ids
+            if len(ids) < page_size:
+                return
+            page_number += 1
+
+    def __fetch_friends_page(self, _facebook_obj, offset, page_size):
+        log.debug("Calling for friends of %s from %s" % (self.facebook_id, offset))
+        fql = app_friends_fql(self.facebook_id, offset, page_size)
+        result = _facebook_obj.batch.add('fql?%s' % urlencode({'q': fql})).resolve()
+        return [str(row['uid']) for row in result.get('data', [])]
 
-    def __get_facebook_info(self,fbids):
+    def __get_facebook_info(self,fbids,fields=None):
         """
            Takes an array of facebook ids and caches all the info that comes
-           back. Returns a tuple - an array of all facebook info, and info for
-           self's fb id.
+           back. Returns a dict of facebook info keyed by facebook id.
         """
-        _facebook_obj = get_facebook_client()
-        all_info = []
-        my_info = None
-        ids_to_get = []
-        for fbid in fbids:
-            if fbid == 0 or fbid is None:
-                continue
-            
-            if _facebook_obj.uid is None:
-                cache_key = 'fb_user_info_%s' % fbid
-            else:
-                cache_key = 'fb_user_info_%s_%s' % (_facebook_obj.uid, fbid)
-        
-            fb_info_cache = cache.get(cache_key)
-            if fb_info_cache:
-                log.debug("Found %s in cache" % fbid)
-                all_info.append(fb_info_cache)
-                if fbid == self.facebook_id:
-                    my_info = fb_info_cache
-            else:
-                log.debug("User info not found in cache at %s" % cache_key)
-                ids_to_get.append(fbid)
-        
-        if len(ids_to_get) > 0:
-            log.debug("Calling for %s" % ids_to_get)
-            tmp_info = _facebook_obj.graph.get_objects([str(x) for x in ids_to_get])
-            
-            all_info.extend(tmp_info)
-            for info_key in tmp_info.keys():
-                info = tmp_info[info_key]
-                if info_key == str(self.facebook_id):
-                    my_info = info
-                
-                if _facebook_obj.uid is None:
-                    cache_key = 'fb_user_info_%s' % fbid
-                else:
-                    cache_key = 'fb_user_info_%s_%s' % (_facebook_obj.uid, info['id'])
-                
-                log.debug('Caching user info with key %s' % cache_key)
-                cache.set(
-                    cache_key, 
-                    info, 
-                    getattr(settings, 'FACEBOOK_CACHE_TIMEOUT', 1800)
-                )
-                
-        return all_info, my_info
+        return get_facebook_info(get_facebook_client(), fbids,
+                                 fields or get_profile_fields())
+
+    def _reload_facebook_info(self, key):
+        """
+        Fetches this profile's info again with the graph field key added to
+        the fields it was fetched with. Returns the new info, or None.
+        """
+        fields = sorted(set(get_profile_fields() or ()) | set([key]))
+        loader = get_profile_loader() or ProfileLoader()
+        try:
+            info = loader.reload(self.facebook_id, key,
+                lambda fbids: self.__get_facebook_info(fbids, fields))
+        except ImproperlyConfigured, ex:
+            log.error('Facebook not setup')
+            return None
+        except (facebook.GraphAPIError, URLError), ex:
+            log.error('Fail reloading profile: %s' % ex)
+            return None
+        if info:
+            self.__facebook_info = info
+        return info
 
     def __configure_me(self):
         """Calls facebook to populate profile info"""
         try:
             log.debug("Configure fb profile %s" % self.facebook_id)
             if self.dummy or self.__facebook_info is None:
-                ids = getattr(_thread_locals, 'fbids', [self.facebook_id])
-                all_info, my_info = self.__get_facebook_info(ids)
+                loader = get_profile_loader() or ProfileLoader()
+                my_info = loader.load(self.facebook_id, self.__get_facebook_info)
                 if my_info:
                     self.__facebook_info = my_info
                     self.dummy = False
@@ -419,12 +412,419 @@ class FacebookProfile(models.Model):
         
         return False
 
+    def load_async(self):
+        """
+        Starts loading this profile's facebook info in the background. See
+        load_many_async.
+        """
+        return FacebookProfile.load_many_async([self])
+
+    @classmethod
+    def load_many_async(cls, profiles):
+        """
+        Starts loading the facebook info for profiles on a background thread
+        and returns right away, so the request can get on with other work in
+        the meantime. Returns a Pending; its wait() method blocks until the
+        info is in and returns it as a dict keyed by facebook id. Profiles
+        loaded under the same ProfileLoader use the info without calling
+        facebook again.
+        """
+        client = resolve_facebook_client(get_facebook_client())
+        fields = get_profile_fields()
+        loader = get_profile_loader() or ProfileLoader()
+        return loader.load_later([p.facebook_id for p in profiles],
+            lambda fbids: get_facebook_info(client, fbids, fields))
+
     def get_absolute_url(self):
         return "http://www.facebook.com/profile.php?id=%s" % self.facebook_id
 
     def __unicode__(self):
         return "FacebookProfile for %s" % self.facebook_id
 
+class FacebookProfileSnapshotManager(models.Manager):
+    def get_info(self, fbids):
+        """returns a dict of the snapshotted info for fbids"""
+        return dict((str(s.facebook_id), s.info)
+                    for s in self.filter(facebook_id__in=fbids))
+
+    @transaction.commit_on_success
+    def store(self, all_info):
+        """
+        save a dict of info keyed by facebook id fresh from facebook, in one
+        transaction. Only store info fetched without a user's access token,
+        snapshots are served to every viewer. Snapshots someone else creates
+        in the meantime are updated instead.
+        """
+        now = datetime.datetime.now()
+        existing = set(str(fbid) for fbid in self.filter(
+            facebook_id__in=all_info.keys()).values_list('facebook_id', flat=True))
+        for fbid, info in all_info.items():
+            data = simplejson.dumps(info)
+            if str(fbid) in existing:
+                self.filter(facebook_id=fbid).update(data=data, fetched_at=now)
+            else:
+                sid = transaction.savepoint()
+                try:
+                    self.create(facebook_id=fbid, data=data, fetched_at=now)
+                    transaction.savepoint_commit(sid)
+                except IntegrityError:
+                    # another worker stored it since we looked
+                    transaction.savepoint_rollback(sid)
+                    self.filter(facebook_id=fbid).update(data=data, fetched_at=now)
+
+    def store_later(self, all_info):
+        """store() on a background thread, so requests don't wait on it"""
+        run_in_background(self.store, all_info)
+
+    def refresh(self, fbids, client=None):
+        """
+        Fetch the public info for fbids from facebook, a batch at a time,
+        and update both the snapshots and the cache. Returns the number of
+        profiles refreshed.
+        """
+        client = client or LocalFacebookClient(None, None)
+        if client.uid is not None:
+            raise ValueError("Snapshots are shared by every viewer, "
+                             "refresh them without a user's access token")
+        batch_size = getattr(settings, 'FACEBOOK_BATCH_SIZE', 50)
+        fbids = [str(fbid) for fbid in fbids]
+        refreshed = 0
+        for start in range(0, len(fbids), batch_size):
+            all_info = fetch_facebook_info(client, fbids[start:start + batch_size],
+                                           snapshot=False)
+            caching.set_many(dict((info_cache_key(client.uid, fbid), info)
+                                  for fbid, info in all_info.items()))
+            self.store(all_info)
+            refreshed += len(all_info)
+        return refreshed
+
+class FacebookProfileSnapshot(models.Model):
+    """
+    The last public info fetched from facebook for a profile, the info
+    anyone can see without logging in. When FACEBOOK_PROFILE_SNAPSHOTS is
+    on, profiles fall back to these if their info isn't cached and facebook
+    can't be reached.
+    """
+    facebook_id = BigIntegerField(unique=True)
+    data = models.TextField()
+    fetched_at = models.DateTimeField()
+
+    objects = FacebookProfileSnapshotManager()
+
+    def __get_info(self):
+        return simplejson.loads(self.data)
+    info = property(__get_info)
+
+    def __unicode__(self):
+        return "FacebookProfileSnapshot for %s" % self.facebook_id
+
+class FacebookFriendEdgeManager(models.Manager):
+    def friend_profiles(self, uid):
+        """the FacebookProfiles of uid's friends, found with one join"""
+        return FacebookProfile.objects.select_related('user').filter(
+            facebook_id__in=self.filter(uid1=uid).values('uid2'))
+
+    @transaction.commit_on_success
+    def set_friends(self, uid, friend_ids):
+        """
+        update uid's edges to match friend_ids, touching only what changed,
+        in one transaction
+        """
+        friend_ids = set(long(fbid) for fbid in friend_ids)
+        current = set(self.filter(uid1=uid).values_list('uid2', flat=True))
+        removed = current - friend_ids
+        if removed:
+            self.filter(uid1=uid, uid2__in=list(removed)).delete()
+        for fbid in friend_ids - current:
+            self.create(uid1=uid, uid2=fbid)
+        if removed or friend_ids - current:
+            cache.delete(app_friends_cache_key(uid))
+        log.debug("Friends of %s: %i added, %i removed"
+                  % (uid, len(friend_ids - current), len(removed)))
+
+    def refresh(self, uid, client):
+        """fetch all of uid's friends from facebook and update the edges"""
+        friend_ids = []
+        args = {'limit': 5000}
+        while args is not None:
+            result = client.graph.get_connections(uid, 'friends', **args)
+            data = result.get('data', [])
+            friend_ids.extend(friend['id'] for friend in data)
+            next_url = result.get('paging', {}).get('next')
+            args = None
+            if data and next_url:
+                args = dict(parse_qsl(urlparse(next_url).query))
+                args.pop('access_token', None)
+        self.set_friends(uid, friend_ids)
+        caching.set('fb_friend_edges_%s' % uid, True)
+
+    def refresh_later(self, uid, client):
+        """refresh uid's edges in the background, unless they're fresh"""
+        cache_key = 'fb_friend_edges_%s' % uid
+        value, stale = caching.get(cache_key)
+        if value is None or stale:
+            # build the client's graph here, not in the worker thread
+            client.graph
+            caching.refresh_later([cache_key],
+                                  lambda keys: self._refresh_in_worker(uid, client))
+
+    def _refresh_in_worker(self, uid, client):
+        # the pool's threads outlive requests, don't leave a connection open
+        try:
+            self.refresh(uid, client)
+        finally:
+            connection.close()
+
+class FacebookFriendEdge(models.Model):
+    """
+    One facebook friendship, from uid1's friend list. Kept up to date when
+    uid1 logs in and by the refreshfacebookfriends command, when
+    FACEBOOK_FRIEND_INDEX is on.
+    """
+    uid1 = BigIntegerField()
+    uid2 = BigIntegerField()
+
+    objects = FacebookFriendEdgeManager()
+
+    class Meta:
+        unique_together = (('uid1', 'uid2'),)
+
+    def __unicode__(self):
+        return "%s is friends with %s" % (self.uid1, self.uid2)
+
+def get_app_friend_ids(client):
+    """
+    facebook ids of client's user's friends who use this site, cached for
+    FACEBOOK_INVITE_CACHE_TIMEOUT seconds. If facebook can't be reached the
+    last list fetched is used, or an empty one, and facebook is asked again
+    after FACEBOOK_INVITE_RETRY_TIMEOUT seconds. Nobody's logged in, nobody
+    to ask about.
+    """
+    if client.uid is None:
+        return []
+    cache_key = app_friends_cache_key(client.uid)
+    stale_ids = None
+    entry = cache.get(cache_key)
+    if entry is not None:
+        fetched_at, stale_ids = entry
+        if time.time() - fetched_at < INVITE_CACHE_TIMEOUT:
+            return stale_ids
+    try:
+        if FRIEND_INDEX and FacebookFriendEdge.objects.filter(uid1=client.uid).exists():
+            friend_ids = [str(fbid) for fbid in
+                          FacebookFriendEdge.objects.friend_profiles(client.uid)
+                                            .values_list('facebook_id', flat=True)]
+        else:
+            result = client.graph.request('fql', {'q': app_friends_fql(client.uid)})
+            friend_ids = [str(row['uid']) for row in result.get('data', [])]
+    except (facebook.GraphAPIError, URLError), ex:
+        log.error("Fail getting friends on the site for %s: %s" % (client.uid, ex))
+        friend_ids = stale_ids or []
+        # dated so it goes stale again once the retry timeout is up
+        fetched_at = time.time() - INVITE_CACHE_TIMEOUT + INVITE_RETRY_TIMEOUT
+    else:
+        fetched_at = time.time()
+    # kept past its timeout to stand in when facebook is down
+    cache.set(cache_key, (fetched_at, friend_ids),
+              max(INVITE_CACHE_TIMEOUT, caching.HARD_TIMEOUT))
+    return friend_ids
+
+def app_friends_fql(uid, offset=None, limit=None):
+    """FQL for the ids of uid's friends who use this app"""
+    fql = ("SELECT uid FROM user WHERE uid IN "
+           "(SELECT uid2 FROM friend WHERE uid1='%s') AND is_app_user = 1"
+           % uid)
+    if limit is not None:
+        fql += " ORDER BY uid LIMIT %i, %i" % (offset or 0, limit)
+    return fql
+
+def app_friends_cache_key(uid):
+    return 'fb_app_friends_%s' % uid
+
+def forget_app_friends(sender, instance, created=False, **kwargs):
+    """
+    A new profile means its friends have one more friend on the site. The
+    friends we know about, from the friend index, get their cached lists
+    dropped. Everyone else waits for FACEBOOK_INVITE_CACHE_TIMEOUT.
+    """
+    if not created or not FRIEND_INDEX:
+        return
+    fbid = long(instance.facebook_id)
+    uids = set()
+    for uid1, uid2 in FacebookFriendEdge.objects.filter(
+            Q(uid1=fbid) | Q(uid2=fbid)).values_list('uid1', 'uid2'):
+        uids.add(uid1 == fbid and uid2 or uid1)
+    if uids:
+        cache.delete_many([app_friends_cache_key(uid) for uid in uids])
+
+def info_cache_key(uid, fbid, fields=None):
+    """
+    cache key for fbid's info as seen by the facebook user uid, fetched with
+    just the graph fields in fields
+    """
+    if uid is None:
+        key = 'fb_user_info_%s' % fbid
+    else:
+        key = 'fb_user_info_%s_%s' % (uid, fbid)
+    if fields:
+        key += '_%s' % hashlib.md5(",".join(fields)).hexdigest()[:8]
+    return key
+
+def get_facebook_info(client, fbids, fields=None):
+    """
+    Returns a dict of info for fbids, as seen by the user of client, keyed by
+    facebook id. Cached info is returned right away, even if it's stale, and
+    stale info gets refreshed in the background. Only ids missing from the
+    cache are fetched before returning. fields limits the info to those
+    graph fields.
+    """
+    keys = {}
+    for fbid in fbids:
+        if fbid and str(fbid) != '0':
+            keys[info_cache_key(client.uid, fbid, fields)] = str(fbid)
+
+    def fetch(cache_keys):
+        info = fetch_facebook_info(client, [keys[k] for k in cache_keys], fields)
+        return dict((info_cache_key(client.uid, fbid, fields), info[fbid])
+                    for fbid in info)
+
+    try:
+        found = caching.get_or_fetch_many(keys.keys(), fetch)
+    except URLError, ex:
+        # facebook is down, slow or the circuit breaker is open. Make do
+        # with whatever we have.
+        log.error('Fail loading profiles, using what we have: %s' % ex)
+        fresh, stale = caching.get_many(keys.keys())
+        found = dict(fresh, **stale)
+        if SNAPSHOTS:
+            missing = [fbid for key, fbid in keys.items() if key not in found]
+            for fbid, info in FacebookProfileSnapshot.objects.get_info(missing).items():
+                found[info_cache_key(client.uid, fbid, fields)] = info
+
+    all_info = {}
+    for cache_key, info in found.items():
+        all_info[keys[cache_key]] = info
+    return all_info
+
+def fetch_facebook_info(client, fbids, fields=None, snapshot=True):
+    """
+    Calls facebook for the info of fbids, along with any queued calls.
+    With FACEBOOK_PROFILE_SNAPSHOTS on, info fetched without a user's access
+    token is snapshotted in the background, unless snapshot is False.
+    """
+    log.debug("Calling for %s" % fbids)
+    # one call per FACEBOOK_BATCH_SIZE ids, all sent in the same batch
+    fbids = list(fbids)
+    chunk_size = getattr(settings, 'FACEBOOK_BATCH_SIZE', 50)
+    args = {}
+    if fields:
+        args['fields'] = ",".join(fields)
+    results = [client.batch.get_objects(fbids[start:start + chunk_size], **args)
+               for start in range(0, len(fbids), chunk_size)]
+    all_info = {}
+    for result in results:
+        all_info.update(result.resolve())
+    if SNAPSHOTS and snapshot and client.uid is None and all_info:
+        FacebookProfileSnapshot.objects.store_later(all_info)
+    bump_info_versions(all_info.keys())
+    return all_info
+
+def run_in_background(func, *args):
+    """
+    Runs func on the refresh pool. The pool's threads live as long as the
+    process, so their database connection is closed after each job.
+    """
+    def run():
+        try:
+            func(*args)
+        finally:
+            connection.close()
+    caching.refresh_pool.submit(run)
+
+def info_version_key(fbid):
+    return 'fb_user_info_version_%s' % fbid
+
+def get_info_versions(fbids):
+    """
+    Returns a dict of version stamps for the info of fbids. A profile's
+    stamp changes every time its info is fetched from facebook. With a
+    loader active, the stamps are looked up once per request.
+    """
+    loader = get_profile_loader()
+    if loader is not None:
+        return loader.load_versions(fbids, _fetch_info_versions)
+    return _fetch_info_versions(fbids)
+
+def _fetch_info_versions(fbids):
+    keys = dict((info_version_key(fbid), fbid) for fbid in fbids)
+    found = cache.get_many(keys.keys())
+    versions = {}
+    for key, fbid in keys.items():
+        if key not in found:
+            # start a new stamp, unless someone just beat us to it
+            version = '%f' % time.time()
+            if not cache.add(key, version, caching.HARD_TIMEOUT):
+                version = cache.get(key, version)
+            found[key] = version
+        versions[fbid] = found[key]
+    return versions
+
+def bump_info_versions(fbids):
+    """give fbids new version stamps, their info just changed"""
+    version = '%f' % time.time()
+    cache.set_many(dict((info_version_key(fbid), version) for fbid in fbids),
+                   caching.HARD_TIMEOUT)
+    loader = get_profile_loader()
+    if loader is not None:
+        loader.versions.update((str(fbid), version) for fbid in fbids)
+
+def prefetch_facebook_profiles(profiles, max_count=None):
+    """
+    Loads the facebook info of profiles, or the first max_count of them, in
+    one pass through the cache and one batch call to facebook. Returns the
+    profiles as a list, ready to render.
+    """
+    profiles = list(islice(profiles, max_count))
+    if not profiles:
+        return profiles
+    try:
+        client = get_facebook_client()
+        fields = get_profile_fields()
+        loader = get_profile_loader() or ProfileLoader()
+        all_info = loader.load_many([p.facebook_id for p in profiles],
+            lambda fbids: get_facebook_info(client, fbids, fields))
+    except ImproperlyConfigured, ex:
+        log.error('Facebook not setup')
+        return profiles
+    except (facebook.GraphAPIError, URLError), ex:
+        log.error('Fail prefetching profiles: %s' % ex)
+        return profiles
+    for profile in profiles:
+        profile._set_facebook_info(all_info.get(str(profile.facebook_id)))
+    return profiles
+
+def get_user_profile(user):
+    """returns user's FacebookProfile, or None if they don't have one"""
+    if user is None or not user.is_authenticated():
+        return None
+    try:
+        return user.facebook_profile
+    except FacebookProfile.DoesNotExist:
+        return None
+
+def user_cache_key(fbid):
+    return 'fb_user_id_%s' % fbid
+
+def forget_profile_user(sender, instance, **kwargs):
+    """drop the cached user ids for a profile that changed"""
+    cache.delete_many([user_cache_key(instance.facebook_id),
+                       user_cache_key(instance._loaded_facebook_id)])
+    instance._loaded_facebook_id = instance.facebook_id
+
+post_save.connect(forget_profile_user, sender=FacebookProfile)
+post_save.connect(forget_app_friends, sender=FacebookProfile)
+post_delete.connect(forget_profile_user, sender=FacebookProfile)
+
 def unregister_fb_profile(sender, **kwargs):
     """call facebook and let them know to unregister the user"""
     fb = get_facebook_client()
@@ -0,0 +1,132 @@
+# Copyright 2008-2009 Brian Boyer, Ryan Mark, Angela Nitzke, Joshua Pollock,
+# Stuart Tiffen, Kayla Webley and the Medill School of Journalism, Northwestern
+# University.
+#
+# This file is part of django-facebookconnect.
+#
+# django-facebookconnect is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-facebookconnect is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with django-facebookconnect.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Profile pictures, worked out from the facebook id alone.
+
+picture_url() points at facebook's /{id}/picture, which is the same for
+every viewer and needs neither an access token nor the profile's info. With
+FACEBOOK_PICTURE_PROXY on it points at the picture view instead, which
+serves pictures out of the cache with ETag and Cache-Control headers so a
+CDN can hold on to them.
+
+Facebook answering 4xx for an id it doesn't know is not an outage, so it
+doesn't count against the circuit breaker. The miss is remembered for
+FACEBOOK_PICTURE_MISSING_TIMEOUT seconds.
+"""
+
+import logging
+log = logging.getLogger('facebookconnect.pictures')
+import hashlib
+import httplib
+import socket
+import urllib2
+from urllib2 import URLError
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+
+from facebookconnect import caching
+from facebookconnect.breaker import graph_breaker
+
+SIZES = ('square', 'small', 'normal', 'large')
+PROXY = getattr(settings, 'FACEBOOK_PICTURE_PROXY', False)
+MAX_AGE = getattr(settings, 'FACEBOOK_PICTURE_MAX_AGE', 3600)
+MISSING_TIMEOUT = getattr(settings, 'FACEBOOK_PICTURE_MISSING_TIMEOUT', 300)
+
+PUBLIC_URL = 'https://graph.facebook.com/'
+GRAPH_URL = getattr(settings, 'FACEBOOK_GRAPH_URL', PUBLIC_URL).rstrip('/') + '/'
+TIMEOUT = getattr(settings, 'FACEBOOK_GRAPH_READ_TIMEOUT', 10)
+
+
+def picture_url(fbid, size='square'):
+    """
+    the url of fbid's profile picture in one of SIZES, served by the avatar
+    mirror or the picture proxy when they're turned on
+    """
+    if size not in SIZES:
+        size = 'square'
+    if getattr(settings, 'FACEBOOK_AVATAR_MIRROR', None):
+        return reverse('facebook_avatar', args=[fbid, size])
+    if PROXY:
+        return reverse('facebook_picture', args=[fbid, size])
+    return facebook_picture_url(fbid, size)
+
+
+def facebook_picture_url(fbid, size='square'):
+    """the url of fbid's profile picture on facebook"""
+    return '%s%s/picture?type=%s' % (PUBLIC_URL, fbid, size)
+
+
+def get_picture(fbid, size='square'):
+    """
+    Returns (content_type, data, etag) for fbid's picture, from the cache
+    when it's there, or None if facebook has no picture for fbid. Raises
+    URLError when facebook can't be reached.
+    """
+    if is_missing(fbid, size):
+        return None
+    picture = caching.get_or_fetch('fb_picture_%s_%s' % (fbid, size),
+                                   lambda: fetch_picture(fbid, size))
+    if picture is None:
+        remember_missing(fbid, size)
+    return picture
+
+
+def is_missing(fbid, size='square'):
+    """whether facebook said it had no picture for fbid not long ago"""
+    return bool(cache.get(_missing_key(fbid, size)))
+
+
+def remember_missing(fbid, size='square'):
+    cache.set(_missing_key(fbid, size), True, MISSING_TIMEOUT)
+
+
+def _missing_key(fbid, size):
+    return 'fb_picture_missing_%s_%s' % (fbid, size)
+
+
+def fetch_picture(fbid, size='square'):
+    """
+    downloads fbid's picture, following facebook's redirect to its cdn.
+    Returns None if facebook says there's no such picture.
+    """
+    log.debug("Fetching picture for %s" % fbid)
+    url = '%s%s/picture?type=%s' % (GRAPH_URL, fbid, size)
+    return graph_breaker.call(_download, url)
+
+
+def _download(url):
+    try:
+        response = urllib2.urlopen(url, timeout=TIMEOUT)
+        try:
+            data = response.read()
+            content_type = response.info().gettype()
+        finally:
+            response.close()
+    except urllib2.HTTPError, ex:
+        if 400 <= ex.code < 500:
+            # facebook is fine, the id just isn't one of theirs
+            log.debug("No picture at %s: %s" % (url, ex))
+            return None
+        raise
+    except (httplib.HTTPException, socket.error), ex:
+        raise URLError(ex)
+    return content_type, data, hashlib.md5(data).hexdigest()
@@ -17,16 +17,82 @@
 #You should have received a copy of the GNU General Public License
 #along with django-facebookconnect.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
+from cgi import escape
+
 from django import template
 from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
 from django.core.urlresolvers import reverse
 from django.template.loader import render_to_string
 from django.contrib.sites.models import Site
 from django.contrib.auth import REDIRECT_FIELD_NAME
 
-from facebookconnect.models import FacebookTemplate, FacebookProfile
+from facebookconnect.loader import get_profile_loader
+from facebookconnect.localfb import get_facebook_client
+from facebookconnect.pictures import picture_url
+from facebookconnect.models import FacebookTemplate, FacebookProfile, \
+    INVITE_CACHE_TIMEOUT, get_app_friend_ids, get_info_versions, get_user_profile, \
+    prefetch_facebook_profiles
 
 register = template.Library()
+
+def _get_profile(context, user):
+    """
+    The FacebookProfile for user, which can be a profile already, or None.
+    The request's user is looked up once per request. Users are matched by
+    pk, since the auth context processor hands templates a lazy copy.
+    """
+    if isinstance(user, FacebookProfile):
+        return user
+    request = context.get('request')
+    request_user = getattr(request, 'user', None)
+    if (request_user is not None and hasattr(request.__class__, 'facebook_profile')
+            and getattr(user, 'pk', None) is not None
+            and user.pk == request_user.pk):
+        return request.facebook_profile
+    return get_user_profile(user)
+
+def _cached_tag(name, p, args, render):
+    """
+    Returns render(), cached for FACEBOOK_TAG_CACHE_TIMEOUT seconds if that's
+    set. The key covers the tag and its args, the profile, the viewer,
+    WIDGET_MODE and the version of the profile's facebook info, so a fresh
+    fetch from facebook retires the old fragments. With a loader active, the
+    fragments of a kind of tag are looked up for the whole page at once.
+    """
+    timeout = getattr(settings, 'FACEBOOK_TAG_CACHE_TIMEOUT', None)
+    if not timeout:
+        return render()
+    widget_mode = getattr(settings, 'WIDGET_MODE', None)
+    try:
+        viewer = get_facebook_client().uid
+    except ImproperlyConfigured:
+        viewer = None
+
+    def make_keys(fbids):
+        versions = get_info_versions(fbids)
+        return dict((fbid, 'fb_tag_%s_%s_%s' % (name, fbid, hashlib.md5(
+            repr((args, viewer, widget_mode, versions[fbid]))).hexdigest()))
+            for fbid in fbids)
+
+    loader = get_profile_loader()
+    if loader is None:
+        result = cache.get(make_keys([p.facebook_id])[p.facebook_id])
+    else:
+        key, result = loader.load_fragment(p.facebook_id, (name, args),
+                                           make_keys, cache.get_many)
+    if result is None:
+        result = render()
+        # don't hang on to dummy info, try facebook again next time
+        if widget_mode or not p.dummy:
+            # rendering may have fetched fresh info and bumped the version
+            key = make_keys([p.facebook_id])[p.facebook_id]
+            cache.set(key, result, timeout)
+            if loader is not None:
+                loader.fragments[key] = result
+    return result
     
 @register.inclusion_tag('facebook/js.html')
 def initialize_facebook_connect():
@@ -34,22 +100,22 @@ def initialize_facebook_connect():
 
 @register.inclusion_tag('facebook/show_string.html', takes_context=True)
 def show_facebook_name(context, user):
-    if isinstance(user, FacebookProfile):
-        p = user
-    else:
-        p = user.facebook_profile
-    if getattr(settings, 'WIDGET_MODE', None):
-        #if we're rendering widgets, link direct to facebook
-        return {'string':u'<fb:name uid="%s" />' % (p.facebook_id)}
-    else:
-        return {'string':u'<a href="%s">%s</a>' % (p.get_absolute_url(), p.full_name)}
+    p = _get_profile(context, user)
+    if p is None:
+        return {'string':''}
+    def render():
+        if getattr(settings, 'WIDGET_MODE', None):
+            #if we're rendering widgets, link direct to facebook
+            return {'string':u'<fb:name uid="%s" />' % (p.facebook_id)}
+        else:
+            return {'string':u'<a href="%s">%s</a>' % (p.get_absolute_url(), p.full_name)}
+    return _cached_tag('name', p, (), render)
 
 @register.inclusion_tag('facebook/show_string.html', takes_context=True)
 def show_facebook_first_name(context, user):
-    if isinstance(user, FacebookProfile):
-        p = user
-    else:
-        p = user.facebook_profile
+    p = _get_profile(context, user)
+    if p is None:
+        return {'string':''}
     if getattr(settings, 'WIDGET_MODE', None):
         #if we're rendering widgets, link direct to facebook
         return {'string':u'<fb:name uid="%s" firstnameonly="true" />' % (p.facebook_id)}
@@ -58,57 +124,63 @@ def show_facebook_first_name(context, user):
     
 @register.inclusion_tag('facebook/show_string.html', takes_context=True)
 def show_facebook_possesive(context, user):
-    if isinstance(user, FacebookProfile):
-        p = user
-    else:
-        p = user.facebook_profile
+    p = _get_profile(context, user)
+    if p is None:
+        return {'string':''}
     return {'string':u'<fb:name uid="%i" possessive="true" linked="false"></fb:name>' % p.facebook_id}
 
 @register.inclusion_tag('facebook/show_string.html', takes_context=True)
 def show_facebook_greeting(context, user):
-    if isinstance(user, FacebookProfile):
-        p = user
-    else:
-        p = user.facebook_profile
-    if getattr(settings, 'WIDGET_MODE', None):
-        #if we're rendering widgets, link direct to facebook
-        return {'string':u'Hello, <fb:name uid="%s" useyou="false" firstnameonly="true" />' % (p.facebook_id)}
-    else:
-        return {'string':u'Hello, <a href="%s">%s</a>!' % (p.get_absolute_url(), p.first_name)}
+    p = _get_profile(context, user)
+    if p is None:
+        return {'string':''}
+    def render():
+        if getattr(settings, 'WIDGET_MODE', None):
+            #if we're rendering widgets, link direct to facebook
+            return {'string':u'Hello, <fb:name uid="%s" useyou="false" firstnameonly="true" />' % (p.facebook_id)}
+        else:
+            return {'string':u'Hello, <a href="%s">%s</a>!' % (p.get_absolute_url(), p.first_name)}
+    return _cached_tag('greeting', p, (), render)
 
 @register.inclusion_tag('facebook/show_string.html', takes_context=True)
 def show_facebook_status(context, user):
-    if isinstance(user, FacebookProfile):
-        p = user
-    else:
-        p = user.facebook_profile
+    p = _get_profile(context, user)
+    if p is None:
+        return {'string':''}
     return {'string':p.status}
 
 @register.inclusion_tag('facebook/show_string.html', takes_context=True)
 def show_facebook_photo(context, user, size="square"):
-    if isinstance(user, FacebookProfile):
-        p = user
-    else:
-        p = user.facebook_profile
-    if p.full_name: name = p.full_name
-    else: name = ""
-    if getattr(settings, 'WIDGET_MODE', None):
-        #if we're rendering widgets, link direct to facebook
-        return {'string':u'<fb:profile_pic uid="%s" facebook-logo="true" />' % (p.facebook_id)}
-    else:
-        return {'string':u' <img src="http://graph.facebook.com/%s/picture?type=%s" alt="%s" />' % (p.username, size, name)}
+    p = _get_profile(context, user)
+    if p is None:
+        return {'string':''}
+    def render():
+        if getattr(settings, 'WIDGET_MODE', None):
+            #if we're rendering widgets, link direct to facebook
+            return {'string':u'<fb:profile_pic uid="%s" facebook-logo="true" />' % (p.facebook_id)}
+        if p.full_name: name = p.full_name
+        else: name = ""
+        return {'string':u' <img src="%s" alt="%s" />' % (picture_url(p.facebook_id, size), name)}
+    return _cached_tag('photo', p, (size,), render)
 
 @register.inclusion_tag('facebook/display.html', takes_context=True)
 def show_facebook_info(context, user):
-    if isinstance(user, FacebookProfile):
-        p = user
-    else:
-        p = user.facebook_profile
-    return {'profile_url':p.get_absolute_url(), 'picture_url':p.picture_url, 'full_name':p.full_name, 'networks':p.networks}
+    p = _get_profile(context, user)
+    if p is None:
+        return {}
+    def render():
+        return {'profile_url':p.get_absolute_url(), 'picture_url':p.picture_url, 'full_name':p.full_name, 'networks':p.networks}
+    return _cached_tag('info', p, (), render)
 
 @register.inclusion_tag('facebook/mosaic.html')
-def show_profile_mosaic(profiles):
-    return {'profiles':profiles}
+def show_profile_mosaic(profiles, max_count=None):
+    """
+    A grid of profile pictures. All the profiles are loaded up front, and
+    at most max_count (default FACEBOOK_MOSAIC_SIZE) are shown.
+    """
+    if max_count is None:
+        max_count = getattr(settings, 'FACEBOOK_MOSAIC_SIZE', None)
+    return {'profiles':prefetch_facebook_profiles(profiles, max_count)}
 
 @register.inclusion_tag('facebook/connect_button.html', takes_context=True)
 def show_connect_button(context):
@@ -116,11 +188,10 @@ def show_connect_button(context):
         redirect_url = context[REDIRECT_FIELD_NAME]
     else: redirect_url = False
     
-    if ('user' in context and hasattr(context['user'], 'facebook_profile') and
-         context['user'].facebook_profile and
-         context['user'].facebook_profile.is_authenticated()):
-        logged_in = True
-    else: logged_in = False
+    p = None
+    if 'user' in context:
+        p = _get_profile(context, context['user'])
+    logged_in = p is not None and p.is_authenticated()
     return {REDIRECT_FIELD_NAME:redirect_url, 'logged_in':logged_in}
 
 @register.simple_tag
@@ -137,34 +208,45 @@ def js_string(value):
     import re
     return re.sub(r'[\r\n]+', '', value)
 
-@register.inclusion_tag('facebook/invite.html')
-def show_invite_link(invitation_template="facebook/invitation.fbml", show_link=True):
-    """display an invite friends link"""
+@register.inclusion_tag('facebook/invite.html', takes_context=True)
+def show_invite_link(context, invitation_template="facebook/invitation.fbml", show_link=True):
+    """
+    display an invite friends link. The invitation links back over https
+    when the page was requested over https.
+    """
     fb = get_facebook_client()
     current_site = Site.objects.get_current()
+    request = context.get('request')
+    scheme = 'https' if request is not None and request.is_secure() else 'http'
     
-    content = render_to_string(invitation_template,
-                               { 'inviter': fb.uid,
-                                 'url': fb.get_add_url(),
-                                 'site': current_site })
-    
-    from cgi import escape 
-    content = escape(content, True) 
-
-    facebook_uid = fb.uid
-    fql = "SELECT uid FROM user WHERE uid IN (SELECT uid2 FROM friend WHERE uid1='%s') AND has_added_app = 1" % fb.uid
-    result = fb.fql.query(fql)
-    # Extract the user ID's returned in the FQL request into a new array.
-    if result and isinstance(result, list):
-        friends_list = map(lambda x: str(x['uid']), result)
-    else: friends_list = []
-    # Convert the array of friends into a comma-delimeted string.
-    exclude_ids = ','.join(friends_list) 
+    # friends who already use the site, as a comma-delimeted string.
+    exclude_ids = ','.join(get_app_friend_ids(fb))
     
     return {
         'exclude_ids':exclude_ids,
-        'content':content,
+        'content':_invitation_content(invitation_template, current_site, fb.uid, scheme),
         'action_url':'',
         'site':current_site,
         'show_link':show_link,
-    }
\ No newline at end of file
+    }
+
+# stands in for the inviter's id in cached invitations
+_INVITER = 'FACEBOOKCONNECTINVITER'
+
+def _invitation_content(invitation_template, site, inviter, scheme='http'):
+    """
+    The escaped invitation from inviter. It's rendered once per site,
+    template and scheme, then cached with a placeholder for the inviter.
+    """
+    cache_key = 'fb_invitation_%s_%s_%s' % (site.id, scheme,
+                                            hashlib.md5(invitation_template).hexdigest())
+    content = cache.get(cache_key)
+    if content is None:
+        content = render_to_string(invitation_template,
+                                   { 'inviter': _INVITER,
+                                     'url': '%s://%s%s' % (scheme, site.domain,
+                                                           reverse('facebook_login')),
+                                     'site': site })
+        content = escape(content, True)
+        cache.set(cache_key, content, INVITE_CACHE_TIMEOUT)
+    return content.replace(_INVITER, escape(str(inviter), True))
@@ -0,0 +1,717 @@
+# Copyright 2008-2009 Brian Boyer, Ryan Mark, Angela Nitzke, Joshua Pollock,
+# Stuart Tiffen, Kayla Webley and the Medill School of Journalism, Northwestern
+# University.
+#
+# This file is part of django-facebookconnect.
+#
+# django-facebookconnect is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-facebookconnect is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with django-facebookconnect.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import errno
+import gzip
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+from urllib2 import URLError
+
+import facebook
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.template import Context, Template
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.utils.functional import SimpleLazyObject
+
+from facebookconnect import caching, mirror, models, pictures, transport
+from facebookconnect.batch import GraphBatch
+from facebookconnect.breaker import BudgetExceededError, CircuitBreaker, \
+    CircuitOpenError, start_budget
+from facebookconnect.loader import ProfileLoader
+from facebookconnect.localfb import LazyFacebookClient, LocalFacebookClient, \
+    get_facebook_client, set_facebook_client
+from facebookconnect.middleware import LazyFacebookProfile
+from facebookconnect.mirror import AvatarMirror
+from facebookconnect.models import FacebookProfile, FacebookProfileSnapshot, \
+    app_friends_cache_key, bump_info_versions, get_app_friend_ids
+from facebookconnect.pictures import facebook_picture_url
+from facebookconnect.templatetags.facebook_tags import _cached_tag
+from facebookconnect.transport import HTTPTransport, PooledGraphAPI, _can_retry
+from facebookconnect.views import avatar
+
+
+class StubGraphHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.handle_call(self)
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+class StubGraphServer(ThreadingMixIn, HTTPServer):
+    """
+    A local stand-in for graph.facebook.com. routes maps a path to a
+    (status, content_type, body) tuple, or to a function that's handed the
+    request handler and answers it itself. Every call is recorded in calls
+    as (method, path, client port).
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubGraphHandler)
+        self.routes = {}
+        self.calls = []
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s/' % self.server_address[1]
+
+    def handle_call(self, handler):
+        length = int(handler.headers.get('content-length') or 0)
+        if length:
+            handler.rfile.read(length)
+        path = handler.path.split('?')[0]
+        self.calls.append((handler.command, path, handler.client_address[1]))
+        route = self.routes.get(path, (404, 'application/json',
+            '{"error": {"type": "GraphMethodException", "message": "Unsupported get request."}}'))
+        if callable(route):
+            return route(handler)
+        status, content_type, body = route
+        respond(handler, status, content_type, body)
+
+    def handle_error(self, request, client_address):
+        # clients hanging up on slow answers is expected here
+        pass
+
+    def count(self, path):
+        return len([call for call in self.calls if call[1] == path])
+
+
+def respond(handler, status, content_type, body, headers=None):
+    handler.send_response(status)
+    handler.send_header('Content-Type', content_type)
+    handler.send_header('Content-Length', str(len(body)))
+    for name, value in (headers or {}).items():
+        handler.send_header(name, value)
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+class HTTPTransportTest(TestCase):
+
+    def setUp(self):
+        self.server = StubGraphServer()
+        self.server.routes['/me'] = (200, 'application/json', '{"id": "1"}')
+        self.transport = HTTPTransport(self.server.url, pool_size=2,
+                                       connect_timeout=1, read_timeout=0.5,
+                                       use_gzip=True)
+
+    def tearDown(self):
+        # hang up so the server's keep-alive threads finish
+        while not self.transport._idle.empty():
+            self.transport._idle.get_nowait().close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_get(self):
+        self.assertEqual(self.transport.request('me', {'fields': 'id'}),
+                         '{"id": "1"}')
+        self.assertEqual(self.server.calls[0][:2], ('GET', '/me'))
+
+    def test_keeps_connection_alive(self):
+        self.transport.request('me')
+        self.transport.request('me')
+        ports = set(call[2] for call in self.server.calls)
+        self.assertEqual(len(ports), 1)
+
+    def test_gzip(self):
+        data = StringIO()
+        f = gzip.GzipFile(fileobj=data, mode='wb')
+        f.write('{"id": "2"}')
+        f.close()
+        self.server.routes['/zipped'] = lambda handler: respond(
+            handler, 200, 'application/json', data.getvalue(),
+            {'Content-Encoding': 'gzip'})
+        self.assertEqual(self.transport.request('zipped'), '{"id": "2"}')
+
+    def test_retries_when_idle_connection_was_dropped(self):
+        def answer_and_hang_up(handler):
+            respond(handler, 200, 'application/json', '{"id": "1"}')
+            handler.close_connection = 1
+        self.server.routes['/me'] = answer_and_hang_up
+        self.transport.request('me')
+        time.sleep(0.1)
+        self.assertEqual(self.transport.request('me'), '{"id": "1"}')
+        self.assertEqual(self.server.count('/me'), 2)
+
+    def test_no_retry_after_timeout(self):
+        def slow(handler):
+            time.sleep(1)
+            respond(handler, 200, 'application/json', '{}')
+        self.server.routes['/slow'] = slow
+        # warm up the pool so the slow call goes out on a reused connection
+        self.transport.request('me')
+        self.assertRaises(URLError, self.transport.request, 'slow')
+        time.sleep(0.1)
+        self.assertEqual(self.server.count('/slow'), 1)
+
+    def test_graph_errors(self):
+        self.server.routes['/me'] = (400, 'application/json',
+            '{"error": {"type": "OAuthException", "message": "Session expired"}}')
+        graph = PooledGraphAPI(transport=self.transport)
+        try:
+            graph.request('me')
+        except facebook.GraphAPIError, ex:
+            self.assertEqual(ex.type, 'OAuthException')
+            self.assertEqual(ex.message, 'Session expired')
+        else:
+            self.fail('no GraphAPIError')
+
+    def test_can_retry(self):
+        reset = socket.error(errno.ECONNRESET, 'Connection reset by peer')
+        self.failUnless(_can_retry(reset, False, False))
+        self.failUnless(_can_retry(reset, True, True))
+        self.failIf(_can_retry(reset, True, False))
+        self.failIf(_can_retry(socket.timeout('timed out'), False, True))
+
+
+class BatchGraph(object):
+    """answers a batch with a canned list of responses"""
+
+    def __init__(self, responses):
+        self.responses = responses
+
+    def request(self, path, args=None, post_args=None):
+        return self.responses
+
+
+class GraphBatchTest(TestCase):
+
+    def test_results_and_errors(self):
+        batch = GraphBatch(BatchGraph([
+            {'code': 200, 'body': '{"id": "1"}'},
+            {'code': 400, 'body': '{"error": {"type": "OAuthException", '
+                                  '"message": "Session expired"}}'},
+            None,
+        ]))
+        me, friend, missing = batch.add('me'), batch.add('2'), batch.add('3')
+        self.assertEqual(me['id'], '1')
+        for result, type in ((friend, 'OAuthException'), (missing, 'BatchError')):
+            try:
+                result.resolve()
+            except facebook.GraphAPIError, ex:
+                self.assertEqual(ex.type, type)
+            else:
+                self.fail('no GraphAPIError')
+
+
+class BudgetTest(TestCase):
+
+    def setUp(self):
+        self.server = StubGraphServer()
+        def slow(handler):
+            time.sleep(0.5)
+            respond(handler, 200, 'application/json', '{}')
+        self.server.routes['/slow'] = slow
+        self.transport = HTTPTransport(self.server.url, connect_timeout=1,
+                                       read_timeout=5)
+        self.breaker = transport.graph_breaker
+        transport.graph_breaker = CircuitBreaker(min_calls=4, window=4)
+
+    def tearDown(self):
+        start_budget(None)
+        transport.graph_breaker = self.breaker
+        while not self.transport._idle.empty():
+            self.transport._idle.get_nowait().close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_budget_timeouts_dont_open_the_circuit(self):
+        graph = PooledGraphAPI(transport=self.transport)
+        for i in range(4):
+            start_budget(0.1)
+            self.assertRaises(BudgetExceededError, graph.request, 'slow')
+        self.assertEqual(transport.graph_breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(len(transport.graph_breaker.calls), 0)
+
+
+class CircuitBreakerTest(TestCase):
+
+    def setUp(self):
+        self.server = StubGraphServer()
+        self.server.routes['/me'] = (503, 'text/html', '<h1>Service Unavailable</h1>')
+        self.transport = HTTPTransport(self.server.url, connect_timeout=1,
+                                       read_timeout=1)
+        self.graph = PooledGraphAPI(transport=self.transport)
+        self.breaker = transport.graph_breaker
+        transport.graph_breaker = CircuitBreaker(min_calls=4, window=4,
+                                                 reset_timeout=0.2)
+
+    def tearDown(self):
+        transport.graph_breaker = self.breaker
+        while not self.transport._idle.empty():
+            self.transport._idle.get_nowait().close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def open_circuit(self):
+        for i in range(4):
+            self.assertRaises(URLError, self.graph.request, 'me')
+        self.assertEqual(transport.graph_breaker.state, CircuitBreaker.OPEN)
+
+    def test_server_errors_open_the_circuit(self):
+        self.open_circuit()
+        self.assertRaises(CircuitOpenError, self.graph.request, 'me')
+        self.assertEqual(self.server.count('/me'), 4)
+
+    def test_answers_that_arent_json_are_failures(self):
+        self.server.routes['/me'] = (200, 'text/html', '<h1>Oops</h1>')
+        self.open_circuit()
+
+    def test_half_open_lets_one_probe_through(self):
+        self.open_circuit()
+        time.sleep(0.25)
+        transport.graph_breaker.before_call()
+        self.assertEqual(transport.graph_breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertRaises(CircuitOpenError, self.graph.request, 'me')
+        transport.graph_breaker.abandon()
+
+    def test_failed_probe_opens_the_circuit_again(self):
+        self.open_circuit()
+        time.sleep(0.25)
+        self.assertRaises(URLError, self.graph.request, 'me')
+        self.assertEqual(transport.graph_breaker.state, CircuitBreaker.OPEN)
+        self.assertRaises(CircuitOpenError, self.graph.request, 'me')
+        self.assertEqual(self.server.count('/me'), 5)
+
+    def test_good_probe_closes_the_circuit(self):
+        self.open_circuit()
+        time.sleep(0.25)
+        self.server.routes['/me'] = (200, 'application/json', '{"id": "1"}')
+        self.assertEqual(self.graph.request('me'), {'id': '1'})
+        self.assertEqual(transport.graph_breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(self.graph.request('me'), {'id': '1'})
+
+
+class CachingTest(TestCase):
+
+    def setUp(self):
+        self.fetched = []
+
+    def tearDown(self):
+        cache.clear()
+
+    def slow_fetch(self, keys):
+        self.fetched.extend(keys)
+        time.sleep(0.2)
+        return dict((key, 'value of %s' % key) for key in keys if key != 'gone')
+
+    def in_thread(self, keys):
+        results = {}
+        def run():
+            results.update(caching.get_or_fetch_many(keys, self.slow_fetch))
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread, results
+
+    def test_overlapping_batches_coalesce(self):
+        first, first_results = self.in_thread(['a', 'b'])
+        time.sleep(0.05)
+        values = caching.get_or_fetch_many(['b', 'c'], self.slow_fetch)
+        first.join()
+        self.assertEqual(sorted(self.fetched), ['a', 'b', 'c'])
+        self.assertEqual(values, {'b': 'value of b', 'c': 'value of c'})
+        self.assertEqual(sorted(first_results), ['a', 'b'])
+
+    def test_missing_keys_dont_keep_anyone_waiting(self):
+        first, first_results = self.in_thread(['gone', 'a'])
+        time.sleep(0.05)
+        start = time.time()
+        values = caching.get_or_fetch_many(['gone', 'a'], self.slow_fetch)
+        first.join()
+        self.failUnless(time.time() - start < 1)
+        self.assertEqual(values, {'a': 'value of a'})
+        # and nobody asks facebook for it again for a while
+        caching.get_or_fetch_many(['gone'], self.slow_fetch)
+        self.assertEqual(sorted(self.fetched), ['a', 'gone'])
+
+    def test_stale_values_are_refreshed_in_the_background(self):
+        cache.set('a', (time.time() - caching.SOFT_TIMEOUT - 1, 'old'))
+        self.assertEqual(caching.get_or_fetch_many(['a'], self.slow_fetch),
+                         {'a': 'old'})
+        deadline = time.time() + 2
+        while caching.get('a') != ('value of a', False) and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(caching.get('a'), ('value of a', False))
+        # the lock is gone once the refresh is done
+        self.assertEqual(caching.lock(['a']), ['a'])
+
+
+class ProfileLoaderTest(TestCase):
+
+    def test_reload_fetches_missing_field_for_the_batch(self):
+        loader = ProfileLoader()
+        loader.fields = ['id', 'name']
+        loader.load_many(['1', '2'], lambda fbids: dict(
+            (fbid, {'id': fbid, 'name': 'Name %s' % fbid}) for fbid in fbids))
+        calls = []
+        def fetch(fbids):
+            calls.append(sorted(fbids))
+            return dict((fbid, {'id': fbid, 'email': '%s@example.com' % fbid})
+                        for fbid in fbids if fbid != '2')
+        info = loader.reload('1', 'email', fetch)
+        self.assertEqual(info['email'], '1@example.com')
+        self.assertEqual(info['name'], 'Name 1')
+        self.assertEqual(loader.fields, ['email', 'id', 'name'])
+        # 2 was fetched along with 1, facebook just didn't say
+        self.assertEqual(loader.reload('2', 'email', fetch)['email'], None)
+        self.assertEqual(calls, [['1', '2']])
+
+    def test_versions_are_looked_up_once_for_the_page(self):
+        loader = ProfileLoader()
+        loader.register('1')
+        loader.register('2')
+        calls = []
+        def fetch(fbids):
+            calls.append(sorted(fbids))
+            return dict((fbid, 'v%s' % fbid) for fbid in fbids)
+        self.assertEqual(loader.load_versions([1], fetch), {1: 'v1'})
+        self.assertEqual(loader.load_versions(['2'], fetch), {'2': 'v2'})
+        self.assertEqual(calls, [['1', '2']])
+
+
+class StubPictureTestCase(TestCase):
+    """
+    Points picture downloads at a stub server with a picture for id 1, and
+    gives them a breaker of their own.
+    """
+
+    def setUp(self):
+        self.server = StubGraphServer()
+        self.server.routes['/1/picture'] = (200, 'image/jpeg', '\xff\xd8 picture')
+        self.graph_url = pictures.GRAPH_URL
+        self.breaker = pictures.graph_breaker
+        pictures.GRAPH_URL = self.server.url
+        pictures.graph_breaker = CircuitBreaker(min_calls=4, window=4)
+
+    def tearDown(self):
+        pictures.GRAPH_URL = self.graph_url
+        pictures.graph_breaker = self.breaker
+        cache.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class PictureTest(StubPictureTestCase):
+
+    def test_get_picture(self):
+        content_type, data, etag = pictures.get_picture('1')
+        self.assertEqual((content_type, data), ('image/jpeg', '\xff\xd8 picture'))
+
+    def test_unknown_ids_dont_open_the_circuit(self):
+        for fbid in range(100, 108):
+            self.assertEqual(pictures.get_picture(fbid), None)
+        self.assertEqual(pictures.graph_breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(pictures.get_picture('1')[0], 'image/jpeg')
+
+    def test_misses_are_remembered(self):
+        pictures.get_picture('100')
+        pictures.get_picture('100')
+        self.assertEqual(self.server.count('/100/picture'), 1)
+
+
+class AvatarMirrorTest(StubPictureTestCase):
+
+    def setUp(self):
+        StubPictureTestCase.setUp(self)
+        self.root = tempfile.mkdtemp()
+        self.mirror = AvatarMirror(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        StubPictureTestCase.tearDown(self)
+
+    def test_fetch(self):
+        path = self.mirror.fetch('1')
+        self.assertEqual(open(path, 'rb').read(), '\xff\xd8 picture')
+        self.assertEqual(self.mirror.get('1')[0], path)
+
+    def test_unknown_ids_dont_open_the_circuit(self):
+        for fbid in range(100, 108):
+            self.mirror._fetch_once((str(fbid), 'square'))
+        self.assertEqual(pictures.graph_breaker.state, CircuitBreaker.CLOSED)
+        self.failUnless(self.mirror.fetch('1'))
+        # the miss is remembered, later requests don't go back to facebook
+        self.mirror.fetch_later('100')
+        self.assertEqual(self.server.count('/100/picture'), 1)
+
+    def test_refresh_doesnt_grow_the_size(self):
+        self.mirror.fetch('1')
+        self.mirror.fetch('1')
+        self.mirror.fetch('1')
+        self.assertEqual(self.mirror._size, self.mirror.disk_usage())
+        self.assertEqual(self.mirror._size, len('\xff\xd8 picture'))
+
+    def test_evict_drops_the_least_recently_served(self):
+        for fbid, served in (('1', 300), ('2', 100), ('3', 200)):
+            path = self.mirror.store(fbid, 'square', '0123456789')
+            os.utime(path, (served, served))
+        self.assertEqual(self.mirror.evict(20), 20)
+        self.assertEqual([fbid for fbid in ('1', '2', '3')
+                          if self.mirror.get(fbid)[0]], ['1', '3'])
+
+    def test_store_evicts_once_the_mirror_is_full(self):
+        self.mirror.max_bytes = 25
+        for fbid in ('1', '2', '3'):
+            self.mirror.store(fbid, 'square', '0123456789')
+        self.failUnless(self.mirror.disk_usage() <= 25 * mirror.EVICT_TO)
+
+
+class AvatarViewTest(StubPictureTestCase):
+
+    def setUp(self):
+        StubPictureTestCase.setUp(self)
+        self.root = tempfile.mkdtemp()
+        self.mirror = mirror._mirror
+        settings.FACEBOOK_AVATAR_MIRROR = self.root
+        mirror._mirror = AvatarMirror(self.root)
+
+    def tearDown(self):
+        mirror._mirror = self.mirror
+        del settings.FACEBOOK_AVATAR_MIRROR
+        if hasattr(settings, 'FACEBOOK_AVATAR_SENDFILE'):
+            del settings.FACEBOOK_AVATAR_SENDFILE
+        shutil.rmtree(self.root)
+        StubPictureTestCase.tearDown(self)
+
+    def get(self, fbid, **headers):
+        return avatar(RequestFactory().get('/', **headers), fbid, 'square')
+
+    def test_sends_unmirrored_pictures_to_facebook_and_mirrors_them(self):
+        response = self.get('1')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Location'], facebook_picture_url('1'))
+        deadline = time.time() + 2
+        while mirror._mirror.get('1')[0] is None and time.time() < deadline:
+            time.sleep(0.05)
+        response = self.get('1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(''.join(response), '\xff\xd8 picture')
+        self.assertEqual(self.get('1', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_sendfile(self):
+        path = mirror._mirror.fetch('1')
+        settings.FACEBOOK_AVATAR_SENDFILE = 'X-Sendfile'
+        self.assertEqual(self.get('1')['X-Sendfile'], path)
+        settings.FACEBOOK_AVATAR_SENDFILE = 'X-Accel-Redirect'
+        self.assertEqual(self.get('1')['X-Accel-Redirect'], '/avatars/square/1')
+
+    def test_missing_pictures_get_the_dummy(self):
+        mirror._mirror.fetch('100')
+        response = self.get('100')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Location'],
+                         FacebookProfile.DUMMY_FACEBOOK_INFO['pic_square_with_logo'])
+
+
+class RequestProfileTest(TestCase):
+
+    def setUp(self):
+        user = User.objects.create(username='fb_1234')
+        FacebookProfile.objects.create(user=user, facebook_id=1234)
+        self.request = RequestFactory().get('/')
+        self.request.__class__.facebook_profile = LazyFacebookProfile()
+        self.request.user = User.objects.get(pk=user.pk)
+        # no client, so profiles render from dummy info without calling out
+        set_facebook_client(None)
+
+    def test_tags_look_up_the_request_user_once(self):
+        template = Template('{% load facebook_tags %}'
+                            '{% show_facebook_name request.user %}'
+                            '{% show_facebook_greeting request.user %}'
+                            '{% show_facebook_name user %}'
+                            '{% show_facebook_greeting user %}')
+        # the auth context processor's user is its own lazy copy
+        user = User.objects.get(pk=self.request.user.pk)
+        context = Context({'request': self.request,
+                           'user': SimpleLazyObject(lambda: user)})
+        self.assertNumQueries(1, template.render, context)
+
+
+class FacebookClientTest(TestCase):
+
+    def tearDown(self):
+        set_facebook_client(None)
+
+    def test_making_a_client_leaves_the_thread_alone(self):
+        client = LocalFacebookClient('1', 'token')
+        set_facebook_client(None)
+        LocalFacebookClient(None, None)
+        self.assertRaises(ImproperlyConfigured, get_facebook_client)
+        set_facebook_client(client)
+        LocalFacebookClient(None, None)
+        self.assertEqual(get_facebook_client(), client)
+
+    def test_async_loads_build_the_client_in_the_request_thread(self):
+        lazy = LazyFacebookClient(RequestFactory().get('/'))
+        set_facebook_client(lazy)
+        pending = FacebookProfile.load_many_async([])
+        self.failIf(lazy._client is None)
+        self.assertEqual(pending.wait(), {})
+
+
+class SnapshotTest(TestCase):
+
+    def test_store_updates_snapshots_stored_since_it_looked(self):
+        manager = FacebookProfileSnapshot.objects
+        manager.create(facebook_id=5, data='{"name": "Old"}',
+                       fetched_at=datetime.datetime.now())
+        real_filter = manager.filter
+        def filter(*args, **kwargs):
+            # the first query is store() looking for existing snapshots,
+            # have it miss the one another worker just made
+            del manager.filter
+            return real_filter(*args, **kwargs).none()
+        manager.filter = filter
+        manager.store({'5': {'name': 'New'}, '6': {'name': 'Six'}})
+        self.assertEqual(manager.get_info(['5', '6']),
+                         {'5': {'name': 'New'}, '6': {'name': 'Six'}})
+
+
+class StubProfile(object):
+    dummy = False
+
+    def __init__(self, facebook_id):
+        self.facebook_id = facebook_id
+
+
+class CachedTagTest(TestCase):
+
+    def setUp(self):
+        settings.FACEBOOK_TAG_CACHE_TIMEOUT = 60
+        set_facebook_client(None)
+        self.rendered = []
+
+    def tearDown(self):
+        del settings.FACEBOOK_TAG_CACHE_TIMEOUT
+        cache.clear()
+
+    def tag(self, fbid, fetch=False):
+        def render():
+            self.rendered.append(fbid)
+            if fetch:
+                # as if the info came fresh from facebook while rendering
+                bump_info_versions([fbid])
+            return {'string': 'Name %s' % fbid}
+        return _cached_tag('name', StubProfile(fbid), (), render)
+
+    def test_fragments_are_reused_until_the_info_changes(self):
+        with ProfileLoader():
+            self.assertEqual(self.tag('1', fetch=True), {'string': 'Name 1'})
+            self.tag('1')
+        with ProfileLoader():
+            self.assertEqual(self.tag('1'), {'string': 'Name 1'})
+        self.assertEqual(self.rendered, ['1'])
+        bump_info_versions(['1'])
+        with ProfileLoader():
+            self.tag('1')
+        self.assertEqual(self.rendered, ['1', '1'])
+
+    def test_page_of_tags_is_looked_up_at_once(self):
+        with ProfileLoader() as loader:
+            for fbid in ('1', '2'):
+                self.tag(fbid)
+        calls = []
+        real_get_many = cache.get_many
+        def get_many(keys):
+            calls.append(keys)
+            return real_get_many(keys)
+        cache.get_many = get_many
+        try:
+            with ProfileLoader() as loader:
+                for fbid in ('1', '2', '3'):
+                    loader.register(fbid)
+                for fbid in ('1', '2', '3'):
+                    self.tag(fbid)
+        finally:
+            del cache.get_many
+        # one call for the version stamps, one for the fragments
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.rendered, ['1', '2', '3'])
+
+
+class DownGraph(object):
+    calls = 0
+
+    def request(self, *args, **kwargs):
+        self.calls += 1
+        raise URLError('facebook is down')
+
+
+class DownClient(object):
+    uid = '1'
+
+    def __init__(self):
+        self.graph = DownGraph()
+
+
+class AppFriendIdsTest(TestCase):
+
+    def tearDown(self):
+        cache.delete(app_friends_cache_key('1'))
+
+    def test_falls_back_to_stale_list(self):
+        cache.set(app_friends_cache_key('1'), (time.time() - 86400, ['2', '3']))
+        self.assertEqual(get_app_friend_ids(DownClient()), ['2', '3'])
+
+    def test_falls_back_to_nobody(self):
+        self.assertEqual(get_app_friend_ids(DownClient()), [])
+
+    def test_fallback_is_cached(self):
+        client = DownClient()
+        get_app_friend_ids(client)
+        get_app_friend_ids(client)
+        self.assertEqual(client.graph.calls, 1)
+
+    def test_unindexed_friends_come_from_facebook(self):
+        friend_index = models.FRIEND_INDEX
+        models.FRIEND_INDEX = True
+        try:
+            client = DownClient()
+            get_app_friend_ids(client)
+            self.assertEqual(client.graph.calls, 1)
+        finally:
+            models.FRIEND_INDEX = friend_index
+
+    def test_nobody_logged_in(self):
+        client = DownClient()
+        client.uid = None
+        self.assertEqual(get_app_friend_ids(client), [])
+        self.assertEqual(client.graph.calls, 0)
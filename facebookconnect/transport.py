@@ -0,0 +1,270 @@
+# Copyright 2008-2009 Brian Boyer, Ryan Mark, Angela Nitzke, Joshua Pollock,
+# Stuart Tiffen, Kayla Webley and the Medill School of Journalism, Northwestern
+# University.
+#
+# This file is part of django-facebookconnect.
+#
+# django-facebookconnect is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-facebookconnect is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with django-facebookconnect.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+HTTP transport for the Graph API.
+
+All graph calls in the process share one HTTPTransport, which keeps a pool
+of keep-alive connections to FACEBOOK_GRAPH_URL. Point that setting at a
+local server to test against a stub, or set FACEBOOK_GRAPH_TRANSPORT to the
+dotted path of your own transport class.
+"""
+
+import logging
+log = logging.getLogger('facebookconnect.transport')
+import errno
+import gzip
+import httplib
+import socket
+import threading
+import time
+from Queue import Queue, Empty, Full
+from StringIO import StringIO
+from urllib import urlencode
+from urllib2 import URLError
+from urlparse import urlparse
+
+import facebook
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import simplejson
+from django.utils.importlib import import_module
+
+from facebookconnect.breaker import BudgetExceededError, get_budget, graph_breaker
+
+
+class HTTPTransport(object):
+    """A thread safe pool of keep-alive connections to the graph API"""
+
+    def __init__(self, base_url=None, pool_size=None, connect_timeout=None,
+                 read_timeout=None, use_gzip=None):
+        url = urlparse(base_url or getattr(settings, 'FACEBOOK_GRAPH_URL',
+                                           'https://graph.facebook.com/'))
+        self.scheme = url.scheme
+        self.host = url.hostname
+        self.port = url.port
+        self.path = url.path.rstrip('/') + '/'
+        self.connect_timeout = connect_timeout or \
+            getattr(settings, 'FACEBOOK_GRAPH_CONNECT_TIMEOUT', 5)
+        self.read_timeout = read_timeout or \
+            getattr(settings, 'FACEBOOK_GRAPH_READ_TIMEOUT', 10)
+        if use_gzip is None:
+            use_gzip = getattr(settings, 'FACEBOOK_GRAPH_GZIP', True)
+        self.use_gzip = use_gzip
+        self._idle = Queue(pool_size or
+                           getattr(settings, 'FACEBOOK_GRAPH_POOL_SIZE', 10))
+
+    def request(self, path, args=None, post_args=None, timeout=None):
+        """
+        Returns the body of the response to a graph API call. timeout caps
+        the read timeout for this call. Raises URLError if the call fails
+        or facebook answers with a 5xx.
+        """
+        timeout = min(timeout or self.read_timeout, self.read_timeout)
+        url = self.path + path.lstrip('/')
+        if args:
+            url += '?' + urlencode(args)
+        headers = {}
+        body = None
+        if post_args is not None:
+            body = urlencode(post_args)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if self.use_gzip:
+            headers['Accept-Encoding'] = 'gzip'
+
+        start = time.time()
+        conn, reused = self._checkout()
+        sent = []
+        try:
+            response, data = self._send(conn, url, body, headers, timeout, sent)
+        except (httplib.HTTPException, socket.error), ex:
+            conn.close()
+            if not reused or not _can_retry(ex, bool(sent), body is None):
+                raise URLError(ex)
+            # the server dropped an idle connection before it saw the call
+            timeout -= time.time() - start
+            if timeout <= 0:
+                raise URLError(ex)
+            log.debug("Retrying %s on a new connection: %s" % (path, ex))
+            conn = self._connect()
+            try:
+                response, data = self._send(conn, url, body, headers, timeout, [])
+            except (httplib.HTTPException, socket.error), ex:
+                conn.close()
+                raise URLError(ex)
+        self._checkin(conn, response)
+
+        if response.status >= 500:
+            raise URLError('graph API answered %s %s'
+                           % (response.status, response.reason))
+        if response.getheader('content-encoding', '') == 'gzip':
+            data = gzip.GzipFile(fileobj=StringIO(data)).read()
+        return data
+
+    def _send(self, conn, url, body, headers, timeout, sent):
+        """sends the call, appending to sent once it's gone out"""
+        if conn.sock is None:
+            conn.connect()
+        conn.sock.settimeout(timeout)
+        conn.request(body is None and 'GET' or 'POST', url, body, headers)
+        sent.append(True)
+        response = conn.getresponse()
+        return response, response.read()
+
+    def _connect(self):
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.host, self.port,
+                                           timeout=self.connect_timeout)
+        return httplib.HTTPConnection(self.host, self.port,
+                                      timeout=self.connect_timeout)
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait(), True
+        except Empty:
+            return self._connect(), False
+
+    def _checkin(self, conn, response):
+        if response.will_close:
+            conn.close()
+            return
+        try:
+            self._idle.put_nowait(conn)
+        except Full:
+            conn.close()
+
+
+def _can_retry(ex, sent, idempotent):
+    """
+    Whether a call that failed on a reused connection can be sent again.
+    Only when facebook can't have acted on it: it never went out, or the
+    server closed the connection without answering. Timeouts never are,
+    they'd just double the wait on a slow facebook.
+    """
+    if isinstance(ex, socket.timeout):
+        return False
+    if not sent:
+        return True
+    if isinstance(ex, httplib.BadStatusLine):
+        return True
+    return (idempotent and isinstance(ex, socket.error)
+            and ex.errno == errno.ECONNRESET)
+
+
+class PooledGraphAPI(facebook.GraphAPI):
+    """
+    A GraphAPI that makes its calls through the shared transport, the
+    circuit breaker and the current request's latency budget.
+    """
+
+    def __init__(self, access_token=None, transport=None):
+        facebook.GraphAPI.__init__(self, access_token)
+        self.transport = transport or get_transport()
+
+    def request(self, path, args=None, post_args=None):
+        args = dict(args or {})
+        if post_args is not None:
+            post_args = dict(post_args)
+        if self.access_token:
+            if post_args is not None:
+                post_args["access_token"] = self.access_token
+            else:
+                args["access_token"] = self.access_token
+
+        budget = get_budget()
+        timeout = None
+        capped = False
+        if budget is not None:
+            timeout = budget.remaining()
+            if timeout <= 0:
+                raise BudgetExceededError('out of time for graph API calls')
+            read_timeout = getattr(self.transport, 'read_timeout', None)
+            capped = read_timeout is None or timeout < read_timeout
+
+        def send():
+            try:
+                body = self.transport.request(path, args, post_args,
+                                              timeout=timeout)
+            except URLError, ex:
+                # timing out on a budget-shortened timeout is the request's
+                # fault, not facebook's, so it mustn't count against the breaker
+                if capped and isinstance(ex.reason, socket.timeout):
+                    raise BudgetExceededError('out of time for graph API calls')
+                raise
+            try:
+                return simplejson.loads(body)
+            except ValueError, ex:
+                # an error page from facebook or a proxy in front of it
+                raise URLError('graph API answered with something that '
+                               'is not JSON: %s' % ex)
+
+        start = time.time()
+        try:
+            response = graph_breaker.call(send)
+        finally:
+            if budget is not None:
+                budget.charge(time.time() - start)
+
+        if isinstance(response, dict) and response.get("error"):
+            raise graph_api_error(response)
+        return response
+
+
+def graph_api_error(response):
+    """
+    A GraphAPIError for an error response from facebook. The sdk only picks
+    up a numeric error_code as the type, so the graph error's type is
+    copied over for checks like ex.type == 'OAuthException'.
+    """
+    error = facebook.GraphAPIError(response)
+    if isinstance(response.get("error"), dict):
+        error.type = response["error"].get("type", error.type)
+    return error
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+def get_transport():
+    """Returns the transport shared by the whole process"""
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = _load_transport()()
+    return _transport
+
+
+def set_transport(transport):
+    """Replaces the shared transport, handy for pointing tests at a stub"""
+    global _transport
+    _transport = transport
+
+
+def _load_transport():
+    path = getattr(settings, 'FACEBOOK_GRAPH_TRANSPORT', None)
+    if not path:
+        return HTTPTransport
+    module, attr = path.rsplit('.', 1)
+    try:
+        return getattr(import_module(module), attr)
+    except (ImportError, AttributeError), ex:
+        raise ImproperlyConfigured('Error loading graph transport %s: %s'
+                                   % (path, ex))
@@ -19,7 +19,7 @@
 
 from django.conf.urls.defaults import *
 from django.views.generic.simple import direct_to_template
-from facebookconnect.views import facebook_login,facebook_logout,setup,detach
+from facebookconnect.views import facebook_login,facebook_logout,setup,detach,picture,avatar
 
 urlpatterns = patterns('',
     url(r'^login/$',
@@ -34,6 +34,12 @@ urlpatterns = patterns('',
     url(r'^detach/$',
         detach,
         name="facebook_detach"),
+    url(r'^picture/(\d+)/(square|small|normal|large)/$',
+        picture,
+        name="facebook_picture"),
+    url(r'^avatar/(\d+)/(square|small|normal|large)/$',
+        avatar,
+        name="facebook_avatar"),
     url(r'^xd_receiver.htm$',
         direct_to_template,
         {'template': 'facebook/xd_receiver.htm'},
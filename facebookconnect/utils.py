@@ -0,0 +1,158 @@
+# Copyright 2008-2009 Brian Boyer, Ryan Mark, Angela Nitzke, Joshua Pollock,
+# Stuart Tiffen, Kayla Webley and the Medill School of Journalism, Northwestern
+# University.
+#
+# This file is part of django-facebookconnect.
+#
+# django-facebookconnect is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-facebookconnect is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with django-facebookconnect.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+log = logging.getLogger('facebookconnect.utils')
+import threading
+from collections import OrderedDict
+from Queue import Queue, Full
+
+
+class LRUCache(object):
+    """A small thread safe dict that forgets the least recently used keys"""
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def items(self):
+        """a copy of the (key, value) pairs, least recently used first"""
+        with self._lock:
+            return self._data.items()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class BackgroundPool(object):
+    """
+    Runs callables on a few daemon threads. Work is dropped, not queued
+    forever, when the pool falls behind.
+    """
+
+    def __init__(self, workers=2, max_queue=100):
+        self.workers = workers
+        self._queue = Queue(max_queue)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        """queue func(*args, **kwargs), returns False if the pool is full"""
+        self._start()
+        try:
+            self._queue.put_nowait((func, args, kwargs))
+            return True
+        except Full:
+            log.warning("Background pool full, dropping %s" % func)
+            return False
+
+    def _start(self):
+        if len(self._threads) >= self.workers:
+            return
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            func, args, kwargs = self._queue.get()
+            try:
+                func(*args, **kwargs)
+            except Exception, ex:
+                log.exception(ex)
+
+
+class Pending(object):
+    """
+    The result of a call handed to a BackgroundPool. If no worker has
+    picked the call up by the time wait() is called, it runs right there.
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        self._call = (func, args, kwargs)
+        self._claimed = False
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def run(self):
+        with self._lock:
+            if self._claimed:
+                return
+            self._claimed = True
+        func, args, kwargs = self._call
+        try:
+            self._result = func(*args, **kwargs)
+        except Exception, ex:
+            self._error = ex
+        self._done.set()
+
+    def done(self):
+        return self._done.isSet()
+
+    def wait(self, timeout=None):
+        """
+        Returns the call's result, raising whatever it raised. Returns None
+        if it's still running after timeout seconds.
+        """
+        self.run()
+        if not self._done.wait(timeout):
+            return None
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+def run_later(pool, func, *args, **kwargs):
+    """Starts func on pool and returns a Pending for its result"""
+    pending = Pending(func, *args, **kwargs)
+    pool.submit(pending.run)
+    return pending
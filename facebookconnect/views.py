@@ -19,8 +19,10 @@
 
 import logging
 log = logging.getLogger('facebookconnect.views')
+from urllib2 import URLError
 
-from django.http import HttpResponse, HttpResponseRedirect, Http404
+from django.http import HttpResponse, HttpResponseRedirect, Http404, \
+    HttpResponseNotModified
 from django.template import RequestContext
 from django.core.urlresolvers import reverse
 from django.shortcuts import render_to_response
@@ -28,10 +30,14 @@ from django.contrib.auth import authenticate, login, logout, REDIRECT_FIELD_NAME
 from django.contrib.auth.forms import AuthenticationForm, UserCreationForm
 from django.contrib.auth.models import User
 from django.conf import settings
+from django.core.servers.basehttp import FileWrapper
 from django.views.decorators.csrf import csrf_exempt
 
 from facebookconnect.models import FacebookProfile
 from facebookconnect.forms import FacebookUserCreationForm
+from facebookconnect.mirror import content_type, get_mirror
+from facebookconnect.pictures import MAX_AGE, facebook_picture_url, get_picture, \
+    is_missing
 
 @csrf_exempt
 def facebook_login(request, redirect_url=None,
@@ -127,9 +133,9 @@ def facebook_logout(request, redirect_url=None):
     
     """
     logout(request)
+    request._cached_facebook_profile = None
     if getattr(request,'facebook',False):
-        request.facebook.session_key = None
-        request.facebook.uid = None
+        request.facebook.clear_session()
     url = getattr(settings,'LOGOUT_REDIRECT_URL',redirect_url) or '/'
     return HttpResponseRedirect(url)
     
@@ -237,6 +243,7 @@ def setup(request,
             else:
                 request.user = User()
                 request.user.facebook_profile = FacebookProfile(facebook_id=request.facebook.uid)
+                request._cached_facebook_profile = request.user.facebook_profile
     
         #user logs in in with an existing account, and the two are linked.
         elif request.POST.get('login',False):
@@ -253,14 +260,13 @@ def setup(request,
             else:
                 request.user = User()
                 request.user.facebook_profile = FacebookProfile(facebook_id=request.facebook.uid)
+                request._cached_facebook_profile = request.user.facebook_profile
     
     #user didn't submit a form, but is logged in already. We'll just link up their facebook
     #account automatically.
     elif request.user.is_authenticated():
         log.debug('Already logged in')
-        try:
-            request.user.facebook_profile
-        except FacebookProfile.DoesNotExist:
+        if request.facebook_profile is None:
             profile = FacebookProfile(facebook_id=request.facebook.uid)
             profile.user = request.user
             profile.save()
@@ -272,6 +278,7 @@ def setup(request,
     else:
         log.debug('Setting up form...')
         request.user.facebook_profile = profile = FacebookProfile(facebook_id=request.facebook.uid)
+        request._cached_facebook_profile = profile
         login_form = login_form_class(request)
         log.debug('creating a dummy user')
         fname = lname = ''
@@ -326,8 +333,8 @@ def detach(request):
         log.debug('Need to be logged into facebook')
         return HttpResponseRedirect(reverse(facebook_login))
     
-    if request.method == "POST" and request.user.facebook_profile:
-        request.user.facebook_profile.delete()
+    if request.method == "POST" and request.facebook_profile:
+        request.facebook_profile.delete()
         log.debug('profile detached')
     
     return HttpResponseRedirect(reverse(facebook_logout))
@@ -339,3 +346,71 @@ class FacebookAuthError(Exception):
     def __str__(self):
         return repr(self.message)
     
+
+def picture(request, facebook_id, size='square'):
+    """
+    Serves a facebook profile picture out of the cache, with headers that let
+    browsers and CDNs keep it for FACEBOOK_PICTURE_MAX_AGE seconds. Sends
+    the user to the dummy picture if facebook can't be reached or has no
+    picture for facebook_id.
+    """
+    try:
+        picture = get_picture(facebook_id, size)
+    except URLError, ex:
+        log.error('Fail loading picture for %s: %s' % (facebook_id, ex))
+        picture = None
+    if picture is None:
+        return HttpResponseRedirect(FacebookProfile.DUMMY_FACEBOOK_INFO['pic_square_with_logo'])
+    content_type, data, etag = picture
+    
+    etag = '"%s"' % etag
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(data, content_type=content_type)
+    response['ETag'] = etag
+    response['Cache-Control'] = 'public, max-age=%d' % MAX_AGE
+    return response
+
+def avatar(request, facebook_id, size='square'):
+    """
+    Serves a profile picture from the avatar mirror. Pictures that haven't
+    been mirrored yet are queued for download, and the user is sent to
+    facebook for them in the meantime. Ids facebook just said it has no
+    picture for get the dummy picture.
+    
+    Set FACEBOOK_AVATAR_SENDFILE to 'X-Sendfile' or 'X-Accel-Redirect' to
+    have the web server send the file. For X-Accel-Redirect, nginx needs
+    an internal location at FACEBOOK_AVATAR_MIRROR_URL that points at the
+    mirror directory.
+    """
+    mirror = get_mirror()
+    if mirror is None:
+        raise Http404
+    path, stat = mirror.get(facebook_id, size)
+    if path is None and is_missing(facebook_id, size):
+        return HttpResponseRedirect(FacebookProfile.DUMMY_FACEBOOK_INFO['pic_square_with_logo'])
+    if path is None:
+        mirror.fetch_later(facebook_id, size)
+        return HttpResponseRedirect(facebook_picture_url(facebook_id, size))
+    
+    etag = '"%x-%x"' % (int(stat.st_mtime), stat.st_size)
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        response = HttpResponseNotModified()
+    else:
+        mime = content_type(path)
+        sendfile = getattr(settings, 'FACEBOOK_AVATAR_SENDFILE', None)
+        if sendfile == 'X-Accel-Redirect':
+            response = HttpResponse(content_type=mime)
+            response[sendfile] = '%s%s/%s' % (
+                getattr(settings, 'FACEBOOK_AVATAR_MIRROR_URL', '/avatars/'),
+                size, facebook_id)
+        elif sendfile:
+            response = HttpResponse(content_type=mime)
+            response[sendfile] = path
+        else:
+            response = HttpResponse(FileWrapper(open(path, 'rb')), content_type=mime)
+            response['Content-Length'] = str(stat.st_size)
+    response['ETag'] = etag
+    response['Cache-Control'] = 'public, max-age=%d' % MAX_AGE
+    return response
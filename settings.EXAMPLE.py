@@ -37,6 +37,112 @@ FACEBOOK_INTERNAL = True
 #Cache facebook info for x seconds
 FACEBOOK_CACHE_TIMEOUT = 1800
 
+#Keep serving stale facebook info, while it's refreshed in the background,
+#for up to x seconds. One fetch per item runs at a time, holding a lock for
+#at most FACEBOOK_CACHE_LOCK_TIMEOUT seconds. Other requests wait up to
+#FACEBOOK_CACHE_WAIT seconds for it before calling facebook themselves.
+#Items facebook has nothing for are remembered for
+#FACEBOOK_CACHE_MISSING_TIMEOUT seconds
+FACEBOOK_CACHE_HARD_TIMEOUT = 7200
+FACEBOOK_CACHE_MISSING_TIMEOUT = 60
+FACEBOOK_CACHE_LOCK_TIMEOUT = 30
+FACEBOOK_CACHE_WAIT = 3
+FACEBOOK_REFRESH_WORKERS = 2
+FACEBOOK_REFRESH_QUEUE_SIZE = 100
+
+#Remember this many verified facebook cookies per process
+FACEBOOK_COOKIE_CACHE_SIZE = 1000
+
+#Fetch at most this many profiles in one graph call, and remember at most
+#FACEBOOK_LOADER_SIZE profiles per request
+FACEBOOK_BATCH_SIZE = 50
+FACEBOOK_LOADER_SIZE = 1000
+
+#Threads that run FacebookProfile.load_many_async calls
+FACEBOOK_LOADER_WORKERS = 4
+FACEBOOK_LOADER_QUEUE_SIZE = 100
+
+#Keep the last info fetched for every profile in the database, and use it
+#when the cache is empty and facebook can't be reached
+FACEBOOK_PROFILE_SNAPSHOTS = False
+
+#Only fetch these graph fields for profiles, like ('name', 'link'). Leave
+#empty to fetch everything.
+FACEBOOK_PROFILE_FIELDS = ()
+
+#Without FACEBOOK_PROFILE_FIELDS, learn which fields each view uses and
+#only fetch those
+FACEBOOK_TRACK_FIELDS = False
+
+#Fetch and cache facebook friend lists this many friends at a time
+FACEBOOK_FRIENDS_PAGE_SIZE = 100
+
+#Keep a local index of who is friends with who, updated on login and by
+#'manage.py refreshfacebookfriends', and use it for friend lists
+FACEBOOK_FRIEND_INDEX = False
+
+#Cache which user each facebook id logs in as for x seconds, None to turn off
+FACEBOOK_USER_CACHE_TIMEOUT = None
+
+#Look up at most this many profiles per database query
+FACEBOOK_QUERY_CHUNK_SIZE = 500
+
+#Graph API calls share a pool of keep-alive connections. Point
+#FACEBOOK_GRAPH_URL at a local stub server for testing.
+FACEBOOK_GRAPH_URL = 'https://graph.facebook.com/'
+FACEBOOK_GRAPH_POOL_SIZE = 10
+FACEBOOK_GRAPH_CONNECT_TIMEOUT = 5
+FACEBOOK_GRAPH_READ_TIMEOUT = 10
+FACEBOOK_GRAPH_GZIP = True
+
+#Stop calling facebook for FACEBOOK_BREAKER_RESET_TIMEOUT seconds when at
+#least half of the last 20 graph calls failed or took longer than 3 seconds
+FACEBOOK_BREAKER_FAILURE_RATE = 0.5
+FACEBOOK_BREAKER_SLOW_CALL_TIME = 3
+FACEBOOK_BREAKER_WINDOW = 20
+FACEBOOK_BREAKER_MIN_CALLS = 10
+FACEBOOK_BREAKER_RESET_TIMEOUT = 30
+
+#Spend at most x seconds per request waiting on graph calls, None for no limit
+FACEBOOK_GRAPH_REQUEST_BUDGET = None
+
+#Requests for these paths skip the facebook middleware entirely. MEDIA_URL
+#and STATIC_URL are always skipped. Entries starting with ^ are regexes.
+FACEBOOK_EXCLUDED_PATHS = ('/health/', '^/api/v[0-9]+/')
+
+#Cache the html of the name, greeting, photo and info tags for x seconds,
+#None to render them every time
+FACEBOOK_TAG_CACHE_TIMEOUT = None
+
+#Show at most x profiles in show_profile_mosaic, None for all of them
+FACEBOOK_MOSAIC_SIZE = None
+
+#Cache each user's list of friends on the site, and the rendered invitation,
+#for show_invite_link for x seconds. Default is FACEBOOK_CACHE_TIMEOUT
+FACEBOOK_INVITE_CACHE_TIMEOUT = 1800
+#When facebook can't be reached, ask it for that list again after x seconds
+FACEBOOK_INVITE_RETRY_TIMEOUT = 60
+
+#Serve profile pictures through the facebook_picture view, out of the cache,
+#and let browsers and CDNs keep them for FACEBOOK_PICTURE_MAX_AGE seconds
+FACEBOOK_PICTURE_PROXY = False
+FACEBOOK_PICTURE_MAX_AGE = 3600
+#Remember for x seconds that facebook has no picture for an id
+FACEBOOK_PICTURE_MISSING_TIMEOUT = 300
+
+#Keep a copy of profile pictures in this directory, at most
+#FACEBOOK_AVATAR_MIRROR_SIZE bytes of them, and serve them from the
+#facebook_avatar view. None turns the mirror off
+FACEBOOK_AVATAR_MIRROR = None
+FACEBOOK_AVATAR_MIRROR_SIZE = 100 * 1024 * 1024
+FACEBOOK_AVATAR_MIRROR_WORKERS = 2
+FACEBOOK_AVATAR_MIRROR_QUEUE_SIZE = 100
+#Let the web server send mirrored pictures: None, 'X-Sendfile' or
+#'X-Accel-Redirect'. nginx needs an internal location at
+#FACEBOOK_AVATAR_MIRROR_URL for the mirror directory
+FACEBOOK_AVATAR_SENDFILE = None
+FACEBOOK_AVATAR_MIRROR_URL = '/avatars/'
+
 #setting this to true will cause facebook to fail randomly
 #only for the masochistic
 RANDOM_FACEBOOK_FAIL = False